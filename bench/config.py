@@ -0,0 +1,157 @@
+"""Measures the load and save latency of the config storage engines and decoders, and the
+memory used by config entries.
+
+A Twitter-like config following `size` users, each in `channels` channels, is loaded with each
+decoder, then with each engine and entry representation: ConfigElements or records. One
+checkpoint is changed before every save, the way a delivered tweet does.
+
+Run from the repository's root: python -m bench.config --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+import config
+
+
+class Follow(config.Record):
+    __slots__ = ('screen_name', 'channels')
+
+
+class Checkpoint(config.Record):
+    __slots__ = ('last_tweet_id',)
+
+
+SCHEMA = config.Schema(int_keys=('follows', 'channels'))
+RECORDS_SCHEMA = config.Schema(int_keys=('follows', 'channels'), records={'follows': Follow, 'channels': Checkpoint})
+
+
+def generate(file, size, channels):
+    """Writes a json config following `size` users in `channels` channels each."""
+    follows = {
+        str(user_id): {
+            '__class__': 'ConfigElement',
+            'screen_name': f'user{user_id}',
+            'channels': {
+                str(100000000 + (user_id + i) % 1000): {'__class__': 'ConfigElement', 'last_tweet_id': 1}
+                for i in range(channels)
+            },
+        }
+        for user_id in range(size)
+    }
+    with open(file, 'w', encoding='utf-8') as fp:
+        json.dump({'__class__': 'ConfigElement', 'credentials': {}, 'follows': follows}, fp)
+
+
+def time_decoders(file):
+    """Returns the load time of plain json, and of a config without and with a schema."""
+    start = time.perf_counter()
+    with open(file, 'r', encoding='utf-8') as fp:
+        json.load(fp)
+    plain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy = config.Config(file, encoding='utf-8')
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    schema = config.Config(file, encoding='utf-8', schema=SCHEMA)
+    schema_time = time.perf_counter() - start
+
+    # Both decoders must agree
+    user_id = next(iter(legacy.follows))
+    assert list(legacy.follows) == list(schema.follows)
+    assert legacy.follows[user_id].channels.keys() == schema.follows[user_id].channels.keys()
+    return plain, legacy_time, schema_time
+
+
+def measure_memory(file, schema):
+    """Returns the memory used by a loaded config, and once saved."""
+    # Saving converts the file to the schema's representation, work on a copy
+    copy = file + '.memory'
+    shutil.copy(file, copy)
+    tracemalloc.start()
+    conf = config.Config(copy, encoding='utf-8', schema=schema)
+    loaded = tracemalloc.get_traced_memory()[0]
+    conf.save()
+    saved = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    conf.close()
+    os.remove(copy)
+    return loaded, saved
+
+
+def run(file, schema, saves):
+    """Returns the load time, and the dumps, write and total times of each save."""
+    start = time.perf_counter()
+    conf = config.Config(file, encoding='utf-8', schema=schema)
+    load = time.perf_counter() - start
+
+    # The first save converts the entries of the generated config to the schema's
+    conf.save()
+    conf.bytes_written = 0
+
+    users = list(conf.follows)
+    timings = []
+    for i in range(saves):
+        conf_element = conf.follows[users[i * 7919 % len(users)]]
+        for channel in conf_element.channels.values():
+            channel.last_tweet_id += 1
+
+        start = time.perf_counter()
+        snapshot = conf.dumps()
+        dumped = time.perf_counter()
+        conf.write(snapshot)
+        written = time.perf_counter()
+        timings.append((dumped - start, written - dumped, written - start))
+
+    bytes_written = conf.bytes_written
+    conf.close()
+    return load, timings, bytes_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='numbers of follows')
+    parser.add_argument('--channels', type=int, default=1, help='number of channels per follow')
+    parser.add_argument('--saves', type=int, default=20, help='number of saves to time per engine')
+    args = parser.parse_args()
+
+    representations = (('elements', SCHEMA), ('records', RECORDS_SCHEMA))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            json_file = os.path.join(directory, f'{size}.json')
+            generate(json_file, size, args.channels)
+            print(f'{size} follows, {size * args.channels} checkpoints: json {os.path.getsize(json_file) / 1024 ** 2:.1f} MB')
+
+            plain, legacy, schema = time_decoders(json_file)
+            print(f'{"decoders":>16}: json.load {plain:.2f} s, without schema {legacy:.2f} s, with schema {schema:.2f} s')
+
+            for name, schema in representations:
+                loaded, saved = measure_memory(json_file, schema)
+                print(f'{name:>16}: {loaded / 1024 ** 2:.1f} MB loaded, {loaded / size:.0f} bytes per follow, '
+                      f'{saved / 1024 ** 2:.1f} MB once saved')
+
+            for engine in ('json', 'sqlite'):
+                for name, schema in representations:
+                    file = os.path.join(directory, f'{size}-{name}.{"db" if engine == "sqlite" else "json"}')
+                    if engine == 'sqlite':
+                        config.migrate(json_file, file)
+                    else:
+                        shutil.copy(json_file, file)
+
+                    load, timings, bytes_written = run(file, schema, args.saves)
+                    dumps, write, total = (statistics.median(t) * 1000 for t in zip(*timings))
+                    p95 = sorted(t[2] for t in timings)[int(len(timings) * 0.95) - 1] * 1000
+                    print(f'{engine + "/" + name:>16}: load {load:.2f} s, save p50 {total:.1f} ms '
+                          f'(dumps {dumps:.1f} ms, write {write:.1f} ms), p95 {p95:.1f} ms, '
+                          f'{bytes_written / args.saves / 1024:.1f} kB written per save')
+
+
+if __name__ == '__main__':
+    main()
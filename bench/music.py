@@ -0,0 +1,434 @@
+"""Offline benchmark of the music pipeline.
+
+The extractor is replaced by a stand-in serving generated audio files over a local http
+server, and voice clients by stand-ins consuming frames at real time pace. Simulated
+guilds then go through `play`, `skip`, `clear` and `stop` while the benchmark reports
+the time to first audio, the gaps between songs, the event loop lag, the CPU spent per
+stream and the peak memory usage.
+
+Requires ffmpeg, like the bot does. Run from the repository's root:
+
+    python -m bench.music --guilds 20 --output before.json
+    python -m bench.music --guilds 20 --baseline before.json
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import discord
+import psutil
+
+from cogs import music
+
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class FakeYoutubeDL:
+    """Stands in for youtube_dl.YoutubeDL, serving the songs of a generated library.
+
+    The library and the simulated latencies are class attributes, so that extraction
+    workers forked after they are set see them as well.
+    """
+    library = {}  # id -> (path on disk, url served)
+    duration = 0
+    extract_latency = 0
+    download_rate = 0
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+
+    def prepare_filename(self, info):
+        return self.params.get('outtmpl', '%(id)s.%(ext)s') % info
+
+    def extract_info(self, url, download=True, process=True, ie_key=None):
+        time.sleep(self.extract_latency)
+        song_id = url.rsplit('/', 1)[-1]
+        if song_id not in self.library:
+            return None
+
+        path, media_url = self.library[song_id]
+        info = {
+            'id': song_id,
+            'extractor': 'fake',
+            'title': f'Song {song_id}',
+            'uploader': 'bench',
+            'ext': 'ogg',
+            'acodec': 'opus',
+            'url': media_url,
+            'webpage_url': f'fake://{song_id}',
+            'duration': self.duration,
+        }
+
+        if download:
+            filename = self.prepare_filename(info)
+            if not os.path.exists(filename):
+                time.sleep(os.path.getsize(path) / self.download_rate)
+                os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+                shutil.copyfile(path, filename + '.part')
+                os.replace(filename + '.part', filename)
+        return info
+
+
+class FakeVoiceClient:
+    """Stands in for discord's VoiceClient, reading its source at real time pace."""
+
+    def __init__(self, channel, stats):
+        self.channel = channel
+        self.stats = stats
+        self.encoder = discord.opus.Encoder() if discord.opus.is_loaded() else None
+        self._source = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._connected = True
+        self.last_frame_at = None
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        self._source = value
+
+    def is_connected(self):
+        return self._connected
+
+    def is_playing(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def play(self, source, *, after=None):
+        self._source = source
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop, after), daemon=True)
+        self._thread.start()
+
+    def _run(self, stop, after):
+        first = True
+        start = time.perf_counter()
+        frames = 0
+        while not stop.is_set():
+            data = self._source.read()
+            if not data:
+                break
+
+            now = time.perf_counter()
+            if first:
+                first = False
+                if self.last_frame_at is not None:
+                    self.stats.gaps.append(now - self.last_frame_at)
+                elif self.channel.id in self.stats.started_at:
+                    self.stats.first_audio.append(now - self.stats.started_at[self.channel.id])
+            self.last_frame_at = now
+
+            # Encode PCM like the voice client does before sending it
+            if self.encoder is not None and not self._source.is_opus():
+                self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+
+            frames += 1
+            self.stats.frames += 1
+            time.sleep(max(0, start + frames * FRAME_LENGTH - time.perf_counter()))
+
+        self._source.cleanup()
+        if after is not None:
+            after(None)
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    def stop(self):
+        self._stop.set()
+
+    async def disconnect(self):
+        self._connected = False
+        self.stop()
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+
+class FakeMessage:
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, member):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.guild = types.SimpleNamespace(id=channel_id)
+        self.mention = f'<#{channel_id}>'
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+
+class FakeVoiceChannel(FakeChannel):
+    def __init__(self, channel_id, stats):
+        super().__init__(channel_id)
+        self.stats = stats
+
+    async def connect(self):
+        return FakeVoiceClient(self, self.stats)
+
+
+class FakeContext:
+    """Stands in for a command context of a guild, with a single author."""
+
+    def __init__(self, bot, guild_id, stats):
+        self.bot = bot
+        self.guild = types.SimpleNamespace(id=guild_id)
+        self.channel = FakeChannel(guild_id)
+        self.author = types.SimpleNamespace(id=guild_id, voice=types.SimpleNamespace(channel=FakeVoiceChannel(guild_id, stats)))
+        self.me = types.SimpleNamespace(id=0)
+        self.message = FakeMessage()
+        self.music_state = None
+
+    @property
+    def voice_client(self):
+        return self.music_state.voice_client
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command(self, *args, **kwargs)
+
+
+class FakeBot:
+    def __init__(self, conf, loop):
+        self.conf = conf
+        self.loop = loop
+
+
+class Stats:
+    """Measurements of a run."""
+
+    def __init__(self):
+        self.started_at = {}  # guild id -> time its first play command started
+        self.first_audio = []
+        self.gaps = []
+        self.loop_lag = []
+        self.frames = 0
+        self.peak_memory = 0
+
+
+def generate_library(directory, size, duration):
+    """Generates `size` opus files of `duration` seconds."""
+    paths = {}
+    for i in range(size):
+        song_id = f'song{i}'
+        path = os.path.join(directory, f'{song_id}.ogg')
+        subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', f'sine=frequency={220 + 20 * i}:duration={duration}',
+                        '-c:a', 'libopus', '-b:a', '96k', path], check=True)
+        paths[song_id] = path
+    return paths
+
+
+def serve(directory):
+    """Serves a directory over http from a background thread, returns the server."""
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=directory)
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def monitor(stats, interval=0.05):
+    """Samples the event loop lag and the memory usage."""
+    process = psutil.Process()
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(time.perf_counter() - start - interval)
+        memory = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                memory += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        stats.peak_memory = max(stats.peak_memory, memory)
+
+
+async def drive_guild(cog, bot, guild_id, args, stats, rng):
+    """Goes through a session of a guild: play a few songs, skip one, clear, then stop."""
+    await asyncio.sleep(rng.uniform(0, args.stagger))
+    ctx = FakeContext(bot, guild_id, stats)
+    songs = [f'fake://song{rng.randrange(args.library)}' for _ in range(args.songs)]
+
+    await cog.cog_before_invoke(ctx)
+    stats.started_at[guild_id] = time.perf_counter()
+    await cog.play(ctx, request=songs[0])
+    for song in songs[1:]:
+        await cog.play(ctx, request=song)
+
+    # Skip half way through the first song
+    await asyncio.sleep(args.duration / 2)
+    if ctx.music_state.is_playing():
+        await cog.skip(ctx)
+
+    # Let the other songs play, except for the last one
+    await asyncio.sleep(args.duration * max(0, args.songs - 2))
+    await cog.clear(ctx)
+    while ctx.music_state.is_playing():
+        await asyncio.sleep(0.1)
+    await cog.stop(ctx)
+
+
+def percentiles(values):
+    """Returns the mean, median, 95th percentile and maximum of values, in milliseconds."""
+    if not values:
+        return None
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return {
+        'mean': statistics.mean(values) * 1000,
+        'p50': statistics.median(values) * 1000,
+        'p95': p95 * 1000,
+        'max': values[-1] * 1000,
+    }
+
+
+async def run(args, conf):
+    loop = asyncio.get_event_loop()
+    stats = Stats()
+    bot = FakeBot({'music': conf}, loop)
+    cog = music.Music(bot)
+    # Bind the commands to the cog, as adding it to a bot would
+    for command in cog.__cog_commands__:
+        command.cog = cog
+    if args.executor == 'thread':
+        cog.pool.executor.shutdown()
+        cog.pool.executor = concurrent.futures.ThreadPoolExecutor(cog.pool.metadata.limit + cog.pool.downloads.limit,
+                                                                  initializer=music._init_worker, initargs=(music.SongInfo.ytdl_opts,))
+
+    rng = random.Random(args.seed)
+    monitor_task = loop.create_task(monitor(stats))
+    cpu_start = time.process_time()
+    children_start = os.times()
+    start = time.perf_counter()
+
+    await asyncio.gather(*(drive_guild(cog, bot, guild_id, args, stats, rng) for guild_id in range(1, args.guilds + 1)))
+
+    wall = time.perf_counter() - start
+    monitor_task.cancel()
+    cog.cog_unload()
+    await asyncio.sleep(0.5)
+
+    # Reap the workers so that their CPU time is accounted for
+    cog.pool.executor.shutdown()
+
+    cpu = time.process_time() - cpu_start
+    children_end = os.times()
+    cpu += (children_end.children_user - children_start.children_user) + (children_end.children_system - children_start.children_system)
+    audio_seconds = stats.frames * FRAME_LENGTH
+
+    return {
+        'guilds': args.guilds,
+        'wall_seconds': wall,
+        'time_to_first_audio_ms': percentiles(stats.first_audio),
+        'inter_song_gap_ms': percentiles(stats.gaps),
+        'loop_lag_ms': percentiles(stats.loop_lag),
+        'cpu_per_stream': cpu / audio_seconds if audio_seconds else None,
+        'peak_memory_mb': stats.peak_memory / 1048576,
+        'cache': str(cog.cache),
+    }
+
+
+def report(results, baseline=None):
+    """Prints the results, compared to a baseline if given."""
+    def compare(value, base):
+        if base is None or not base:
+            return ''
+        return f' ({(value - base) / base:+.0%} vs {base:.2f})'
+
+    for key, value in results.items():
+        base = baseline.get(key) if baseline else None
+        if isinstance(value, dict):
+            parts = [f'{k} {v:.2f}{compare(v, base.get(k) if base else None)}' for k, v in value.items()]
+            print(f'{key}: {", ".join(parts)}')
+        elif isinstance(value, float):
+            print(f'{key}: {value:.4f}{compare(value, base)}')
+        else:
+            print(f'{key}: {value}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=10, help='number of simulated guilds')
+    parser.add_argument('--songs', type=int, default=4, help='songs requested per guild')
+    parser.add_argument('--library', type=int, default=20, help='number of distinct songs')
+    parser.add_argument('--duration', type=float, default=6, help='duration of each song in seconds')
+    parser.add_argument('--stagger', type=float, default=1, help='spread of the guilds start times in seconds')
+    parser.add_argument('--extract-latency', type=float, default=0.2, help='simulated extraction latency in seconds')
+    parser.add_argument('--download-rate', type=float, default=1 << 20, help='simulated download rate in bytes per second')
+    parser.add_argument('--executor', choices=('process', 'thread'), default='process' if multiprocessing.get_start_method() == 'fork' else 'thread',
+                        help='how to run the extraction workers, processes require the fork start method')
+    parser.add_argument('--conf', default='{}', help='music conf as json, e.g. \'{"stream": true, "opus": true}\'')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to save the results to, as json')
+    parser.add_argument('--baseline', help='results file to compare against')
+    args = parser.parse_args()
+
+    if shutil.which('ffmpeg') is None:
+        sys.exit('ffmpeg is required.')
+
+    repo = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        library_dir = os.path.join(workdir, 'library')
+        os.mkdir(library_dir)
+        paths = generate_library(library_dir, args.library, args.duration)
+        server = serve(library_dir)
+        host, port = server.server_address
+
+        FakeYoutubeDL.library = {song_id: (path, f'http://{host}:{port}/{os.path.basename(path)}') for song_id, path in paths.items()}
+        FakeYoutubeDL.duration = args.duration
+        FakeYoutubeDL.extract_latency = args.extract_latency
+        FakeYoutubeDL.download_rate = args.download_rate
+
+        # Swap the extractor, worker processes create theirs from youtube_dl.YoutubeDL
+        music.youtube_dl.YoutubeDL = FakeYoutubeDL
+        music.SongInfo.ytdl = FakeYoutubeDL(music.SongInfo.ytdl_opts)
+
+        # Keep the audio cache out of the repository
+        os.chdir(workdir)
+        try:
+            results = asyncio.get_event_loop().run_until_complete(run(args, json.loads(args.conf)))
+        finally:
+            os.chdir(repo)
+            server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Measures the CPU cost per stream of the PCM and opus passthrough playback paths.
+
+Songs are read as fast as possible, the way the voice client would read them, and PCM
+frames are encoded to opus just like the voice client does before sending them. Files
+already encoded in opus are also played at full volume, which ffmpeg only remuxes.
+
+Run from the repository's root: python -m bench.playback music/Yeah.mp3 --streams 8
+"""
+import argparse
+import os
+import subprocess
+import time
+
+import discord
+
+from cogs import music
+
+
+def probe_codec(path):
+    """Returns the codec of the first audio stream of a file."""
+    return subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=codec_name',
+                                    '-of', 'csv=p=0', path]).decode().strip()
+
+
+def run(path, streams, seconds, volume, opus, acodec=None):
+    """Plays `streams` songs for `seconds` of audio each and returns the CPU time spent."""
+    song_info = music.SongInfo.from_file(path, None, None)
+    if acodec is not None:
+        # Known for downloaded songs, which the remux path depends on
+        song_info.info['acodec'] = acodec
+    songs = [music.Song(song_info, volume, opus=opus) for _ in range(streams)]
+    encoder = discord.opus.Encoder()
+    frames = int(seconds * 1000 / discord.opus.Encoder.FRAME_LENGTH)
+
+    start = time.process_time()
+    start_children = os.times()
+    played = 0
+    for _ in range(frames):
+        for song in songs:
+            data = song.read()
+            if not data:
+                continue
+            if not song.is_opus():
+                encoder.encode(data, encoder.SAMPLES_PER_FRAME)
+            played += 1
+    bot_cpu = time.process_time() - start
+
+    # ffmpeg's time is accounted for once its process has been reaped
+    for song in songs:
+        song.cleanup()
+    end_children = os.times()
+    ffmpeg_cpu = (end_children.children_user - start_children.children_user) + (end_children.children_system - start_children.children_system)
+
+    audio_seconds = played * discord.opus.Encoder.FRAME_LENGTH / 1000
+    return audio_seconds, bot_cpu, ffmpeg_cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='audio file to play')
+    parser.add_argument('--streams', type=int, default=4, help='number of concurrent streams')
+    parser.add_argument('--seconds', type=float, default=30, help='seconds of audio to play per stream')
+    parser.add_argument('--volume', type=float, default=0.5, help='volume to play at')
+    args = parser.parse_args()
+
+    cases = [('pcm', args.volume, False), ('opus', args.volume, True)]
+    acodec = probe_codec(args.file)
+    if acodec == 'opus':
+        cases.append(('remux', 1.0, True))
+    else:
+        print(f'Not measuring the remux path, the file is encoded in {acodec} rather than opus')
+
+    print(f'{args.streams} streams of {args.seconds} seconds at volume {args.volume}')
+    for name, volume, opus in cases:
+        audio_seconds, bot_cpu, ffmpeg_cpu = run(args.file, args.streams, args.seconds, volume, opus, acodec)
+        if audio_seconds == 0:
+            print(f'{name:>5}: no audio played')
+            continue
+
+        # CPU seconds per second of audio is the share of a core a real time stream needs
+        print(f'{name:>5}: bot {bot_cpu / audio_seconds:.2%} of a core per stream, '
+              f'ffmpeg {ffmpeg_cpu / audio_seconds:.2%} of a core per stream')
+
+
+if __name__ == '__main__':
+    main()
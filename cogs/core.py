@@ -1,12 +1,18 @@
-import json
-import time
+import asyncio
+import collections
+import logging
 import subprocess
+import time
 
 import discord
 import discord.ext.commands as commands
 
 import psutil
 
+import handoff
+
+log = logging.getLogger(__name__)
+
 
 def setup(bot):
     bot.add_cog(Core(bot))
@@ -27,10 +33,85 @@ def duration_to_str(duration):
     return ', '.join(duration)
 
 
+def read_changelog(count=5):
+    """Returns the latest commits, formatted for an embed."""
+    return subprocess.check_output(['git', 'log', '--pretty=format:[`%h`](https://github.com/PapyrusThePlant/Panda/commit/%h) %s', '-n', str(count)]).decode('utf-8')
+
+
+Sample = collections.namedtuple('Sample', 'time cpu uss rss loop_lag guilds voice_clients')
+
+
+class StatsCollector:
+    """Samples the bot's resource usage in the background.
+
+    Samples are taken every `interval` seconds and the latest `size` of them are kept. The
+    expensive ones are taken off the event loop.
+    """
+
+    def __init__(self, bot, interval=30, size=120):
+        self.bot = bot
+        self.interval = interval
+        self.samples = collections.deque(maxlen=size)
+        self.changelog = None
+        self._task = None
+
+    @property
+    def latest(self):
+        """The latest sample, or None."""
+        return self.samples[-1] if self.samples else None
+
+    def start(self, loop):
+        """Starts sampling."""
+        self._task = loop.create_task(self._run(loop))
+
+    def stop(self):
+        """Stops sampling."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, loop):
+        try:
+            self.changelog = await loop.run_in_executor(None, read_changelog)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log.warning(f'Could not read the changelog: {e}')
+
+        process = psutil.Process()
+        psutil.cpu_percent(None)  # The first call only starts the measurement
+        delay = 1
+        while True:
+            expected = loop.time() + delay
+            await asyncio.sleep(delay)
+            loop_lag = loop.time() - expected
+
+            # Reading the USS walks the whole memory map of the process
+            memory = await loop.run_in_executor(None, process.memory_full_info)
+            self.samples.append(Sample(time.time(), psutil.cpu_percent(None), memory.uss, memory.rss, loop_lag,
+                                       len(self.bot.guilds), len(self.bot.voice_clients)))
+            delay = self.interval
+
+    def __str__(self):
+        sample = self.latest
+        if sample is None:
+            return 'No sample yet'
+
+        window = duration_to_str(int(sample.time - self.samples[0].time))
+        return (f'CPU {sample.cpu}% (max {max(s.cpu for s in self.samples)}%), '
+                f'USS {sample.uss / 1048576:.1f} Mb, RSS {sample.rss / 1048576:.1f} Mb (max {max(s.rss for s in self.samples) / 1048576:.1f} Mb), '
+                f'loop lag {sample.loop_lag * 1000:.0f} ms (max {max(s.loop_lag for s in self.samples) * 1000:.0f} ms), '
+                f'{sample.guilds} guilds, {sample.voice_clients} voice clients, over the last {window}')
+
+
 class Core(commands.Cog):
     """♡🐼"""
     def __init__(self, bot):
         self.bot = bot
+        self.stats = StatsCollector(bot, bot.conf.get('stats_interval', 30))
+        self.stats.start(bot.loop)
+
+    def cog_unload(self):
+        """Handles special unloading."""
+        self.stats.stop()
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -39,21 +120,31 @@ class Core(commands.Cog):
     @commands.command(aliases=['infos'])
     async def info(self, ctx):
         """Shows info about the bot."""
-        latest_commits = subprocess.check_output(['git', 'log', '--pretty=format:[`%h`](https://github.com/PapyrusThePlant/Panda/commit/%h) %s', '-n', '5']).decode('utf-8')
+        sample = self.stats.latest
 
         embed = discord.Embed(description='[Click here to get your own Panda!](https://github.com/PapyrusThePlant/Panda)', colour=discord.Colour.blurple())
         embed.set_thumbnail(url='https://raw.githubusercontent.com/PapyrusThePlant/Panda/master/images/panda.jpg')
         embed.set_author(name='Author : Papyrus#0095', icon_url='https://cdn.discordapp.com/avatars/145110704293281792/2775b3ee7b6a865722b3f6a27da8b14a.webp?size=1024')
         embed.add_field(name='Command prefixes', value=f'`@{ctx.guild.me.display_name} `, `{self.bot.conf["prefix"]}`', inline=False)
-        embed.add_field(name='CPU', value=f'{psutil.cpu_percent()}%')
-        embed.add_field(name='Memory', value=f'{psutil.Process().memory_full_info().uss / 1048576:.2f} Mb')  # Expressed in bytes, turn to Mb and round to 2 decimals
+        if sample is not None:
+            embed.add_field(name='CPU', value=f'{sample.cpu}%')
+            embed.add_field(name='Memory', value=f'{sample.uss / 1048576:.2f} Mb')  # Expressed in bytes, turn to Mb and round to 2 decimals
         embed.add_field(name='Uptime', value=duration_to_str(int(time.time() - self.bot.start_time)))
-        embed.add_field(name='Latest changes', value=latest_commits, inline=False)
+        embed.add_field(name='Latest changes', value=self.stats.changelog or 'Unavailable', inline=False)
         embed.add_field(name='\N{ZERO WIDTH SPACE}', value='For any question about the bot, announcements and an easy way to get in touch with the author, feel free to join the dedicated [discord server](https://discord.gg/AvAsTHW).')
         embed.set_footer(text='Powered by discord.py', icon_url='http://i.imgur.com/5BFecvA.png')
 
         await ctx.send(embed=embed)
 
+    @commands.command()
+    @commands.is_owner()
+    async def botstats(self, ctx):
+        """Shows the bot's resource usage.
+
+        Only the bot owner can use this command.
+        """
+        await ctx.send(f'{self.stats}\n{self.bot.format_startup_profile()}')
+
     @commands.command()
     @commands.has_permissions(manage_guild=True)
     async def load(self, ctx, name):
@@ -70,8 +161,7 @@ class Core(commands.Cog):
             await ctx.send(f'Extension {name} not found.')
         else:
             self.bot.conf['extensions'].append(cog)
-            with open(self.bot.conf_file, 'w') as fp:
-                json.dump(self.bot.conf, fp)
+            self.bot.conf.save()
             await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
     @commands.command()
@@ -88,8 +178,7 @@ class Core(commands.Cog):
             await ctx.send(f'Extension {name} not loaded.')
         else:
             self.bot.conf['extensions'].remove(cog)
-            with open(self.bot.conf_file, 'w') as fp:
-                json.dump(self.bot.conf, fp)
+            self.bot.conf.save()
             await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
     @commands.command()
@@ -98,19 +187,24 @@ class Core(commands.Cog):
         """Reloads extensions.
 
         If none are provided, reloads all loaded extensions.
+        Music players and Twitter streams keep running through the reload.
 
         This command requires the Manage Server permission.
         """
-        if extensions is None:
+        if not extensions:
             extensions = self.bot.conf['extensions']
 
         for name in extensions:
-            cog = name.lower()
+            extension = f'cogs.{name.lower()}'
+            # The cogs hand their live state over to their new instances, rather than starting cold
+            handoff.begin(ctx.bot, extension)
             try:
-                ctx.bot.unload_extension(f'cogs.{cog}')
-                ctx.bot.load_extension(f'cogs.{cog}')
+                ctx.bot.unload_extension(extension)
+                ctx.bot.load_extension(extension)
             except commands.ExtensionError as e:
                 await ctx.send(f'Error reloading extension {name} : {e}')
+            finally:
+                handoff.end(ctx.bot, extension)
 
         await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
@@ -1,13 +1,32 @@
 import asyncio
+import collections
+import concurrent.futures
 import functools
+import glob
+import heapq
+import itertools
 import logging
+import math
 import os
 import pathlib
+import random
+import shlex
+import time
+import urllib.parse
+import weakref
 
 import discord
 import discord.ext.commands as commands
 import youtube_dl
 
+import handoff
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Version of the state handed over on reload, bump it when that state changes shape so that reloads start cold
+HANDOFF_VERSION = 1
+
 
 def setup(bot):
     """Extension's entry point."""
@@ -34,28 +53,691 @@ class MusicError(commands.UserInputError):
     pass
 
 
-class Song(discord.PCMVolumeTransformer):
-    """Represents a song to play."""
+# Each extraction worker process owns its ytdl instance, which is not thread safe to share
+_worker_ytdl = None
+
+
+def _init_worker(ytdl_opts):
+    """Initializes an extraction worker."""
+    global _worker_ytdl
+    _worker_ytdl = youtube_dl.YoutubeDL(ytdl_opts)
+
+
+def _extract_info(url, **kwargs):
+    """Extracts info with the worker's ytdl."""
+    info = _worker_ytdl.extract_info(url, **kwargs)
+
+    # Lazily extracted playlists have to be materialized to be sent back from the worker
+    if info is not None and 'entries' in info and not isinstance(info['entries'], list):
+        entries = info['entries']
+        info['entries'] = entries.getslice() if isinstance(entries, youtube_dl.utils.PagedList) else list(entries)
+    return info
+
+
+def _extract_playlist(url):
+    """Extracts the sparse entries of a playlist with the worker's ytdl."""
+    params = _worker_ytdl.params
+    noplaylist = params.get('noplaylist')
+    params['noplaylist'] = False
+    try:
+        return _extract_info(url, download=False, process=False)
+    finally:
+        params['noplaylist'] = noplaylist
+
+
+def _remove_file(filename):
+    """Removes a file from the disk, if it still exists."""
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _download(url):
+    """Downloads a file with the worker's ytdl, returns whether it succeeded."""
+    return _worker_ytdl.extract_info(url, download=True) is not None
+
+
+class AudioCache:
+    """On-disk cache of downloaded songs, shared by all guilds.
+
+    Files are indexed by their cache key and evicted in least recently used order once the cache
+    grows over its byte budget. Files referenced by a queued or playing song are never evicted.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()  # key -> (filename, size), least recently used first
+        self._refs = collections.Counter()
+        self._downloads = {}
+
+        # Deleting large files can stall, leave it to a background worker
+        self._cleaner = concurrent.futures.ThreadPoolExecutor(1)
+        self._deleting = {}
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """Indexes the files already present in the cache directory, oldest first."""
+        files = []
+        for path in self.directory.iterdir():
+            if not path.is_file():
+                continue
+            if path.suffix == '.part':
+                # Leftover of an interrupted download
+                path.unlink()
+                continue
+            stat = path.stat()
+            files.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(files):
+            self._entries[path.stem] = (str(path), size)
+            self.size += size
+        self.evict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """Indicates if the key is cached, marking it as recently used."""
+        if key in self._entries and os.path.exists(self._entries[key][0]):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def filename(self, key):
+        """Returns the file cached for the key, or None."""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def _locate(self, key, filename):
+        """Returns the file downloaded for the key, whose format may differ from the expected one, or None."""
+        if os.path.exists(filename):
+            return filename
+        for path in self.directory.glob(glob.escape(key) + '.*'):
+            if path.suffix not in ('.part', '.ytdl'):
+                return str(path)
+        return None
+
+    def add(self, key, filename):
+        """Adds a freshly downloaded file to the cache."""
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+
+        size = os.path.getsize(filename)
+        self._entries[key] = (filename, size)
+        self.size += size
+        self.evict()
+
+    def add_when_done(self, key, filename, job):
+        """Adds a file to the cache once the job downloading it succeeded, for downloads nobody waits for anymore."""
+        def done(job):
+            if not job.cancelled() and job.exception() is None and job.result():
+                downloaded = self._locate(key, filename)
+                if downloaded is not None:
+                    self.add(key, downloaded)
+        job.add_done_callback(done)
+
+    def acquire(self, key):
+        """Marks the key as in use, protecting its file from eviction."""
+        if key is not None:
+            self._refs[key] += 1
+
+    def release(self, key):
+        """Releases a reference taken with `acquire`."""
+        if key is None:
+            return
+
+        self._refs[key] -= 1
+        if self._refs[key] <= 0:
+            del self._refs[key]
+
+            # Nobody is waiting for that file anymore
+            if key in self._downloads:
+                self._downloads[key].cancel()
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used unreferenced files until the cache fits its budget."""
+        for key in list(self._entries):
+            if self.size <= self.max_size:
+                break
+            if self._refs[key] > 0:
+                continue
+
+            filename, size = self._entries.pop(key)
+            self.size -= size
+            self.evictions += 1
+            self._deleting[key] = self._cleaner.submit(_remove_file, filename)
+
+        self._deleting = {k: f for k, f in self._deleting.items() if not f.done()}
+
+    async def fetch(self, key, filename, download):
+        """Makes sure the key is cached, awaiting `download()` on a miss.
+
+        Concurrent fetches of the same key share a single download. Returns the time spent
+        downloading if this call started the download, None otherwise.
+        """
+        if self.lookup(key):
+            return None
+
+        task = self._downloads.get(key)
+        if task is None:
+            # Don't let a pending deletion remove the new download
+            deletion = self._deleting.pop(key, None)
+            if deletion is not None:
+                await asyncio.wrap_future(deletion)
+                task = self._downloads.get(key)
+
+        started_at = None
+        if task is None:
+            started_at = time.perf_counter()
+            task = asyncio.ensure_future(download())
+            self._downloads[key] = task
+
+            def done(t):
+                del self._downloads[key]
+                if not t.cancelled() and t.exception() is None:
+                    downloaded = self._locate(key, filename)
+                    if downloaded is not None:
+                        self.add(key, downloaded)
+            task.add_done_callback(done)
+
+        await asyncio.shield(task)
+        return None if started_at is None else time.perf_counter() - started_at
+
+    def __str__(self):
+        ratio = self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+        return (f'{len(self)} files, {self.size / 1048576:.2f}/{self.max_size / 1048576:.2f} Mb, '
+                f'{self.hits} hits, {self.misses} misses ({ratio:.0%}), {self.evictions} evictions')
+
+
+class ResolutionCache:
+    """Memoizes the info ytdl resolves from queries and urls, shared by all guilds.
+
+    Failed resolutions are remembered for a short while as well, and concurrent
+    resolutions of the same query share a single extraction.
+    """
+
+    def __init__(self, ttl=3600, negative_ttl=30, max_size=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (expires_at, info), info is None for failures
+        self._pending = {}
+
+    @staticmethod
+    def normalize(query):
+        """Returns the cache key of a query, urls are kept as is since they are case sensitive."""
+        query = query.strip()
+        if '://' in query:
+            return query
+        return ' '.join(query.lower().split())
+
+    def ttl_for(self, info):
+        """Returns how long an info can be cached, without outliving its media url."""
+        params = urllib.parse.parse_qs(urllib.parse.urlparse(info.get('url', '')).query)
+        try:
+            # Media urls like youtube's carry their expiration timestamp
+            expires_in = int(params['expire'][0]) - time.time() - 60
+        except (KeyError, ValueError):
+            return self.ttl
+        return min(self.ttl, expires_in)
+
+    def get(self, query):
+        """Returns a tuple (found, info) for the given query, info is None for a cached failure."""
+        key = self.normalize(query)
+        try:
+            expires_at, info = self._entries[key]
+        except KeyError:
+            return False, None
+
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, info
+
+    def put(self, query, info, ttl):
+        """Caches an info, or a failure if info is None."""
+        if ttl <= 0:
+            return
+
+        key = self.normalize(query)
+        self._entries[key] = (time.monotonic() + ttl, info)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def resolve(self, query, resolve):
+        """Returns the info resolved from a query, awaiting `resolve()` if it is not cached."""
+        found, info = self.get(query)
+        if found:
+            self.hits += 1
+            if info is None:
+                raise MusicError(f'Could not retrieve info from input : {query}')
+            return dict(info)
+
+        key = self.normalize(query)
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(resolve())
+            self._pending[key] = task
+
+            def done(t):
+                del self._pending[key]
+                if t.cancelled():
+                    return
+                if isinstance(t.exception(), MusicError):
+                    self.put(query, None, self.negative_ttl)
+                elif t.exception() is None:
+                    info = t.result()
+                    ttl = self.ttl_for(info)
+                    self.put(query, info, ttl)
+                    if 'webpage_url' in info:
+                        self.put(info['webpage_url'], info, ttl)
+            task.add_done_callback(done)
+        else:
+            self.hits += 1
+
+        return dict(await asyncio.shield(task))
+
+    def __str__(self):
+        ratio = self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+        return f'{len(self._entries)} entries, {self.hits} hits, {self.misses} misses ({ratio:.0%})'
+
+
+class _PoolLane:
+    """A queue of jobs of an ExtractionPool, with its own concurrency limit."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.running = 0
+        self.queue = []  # heap of (priority, sequence, enqueued_at, future, func)
+        self.jobs = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def record_wait(self, wait):
+        """Records how long a job waited in the queue."""
+        self.jobs += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def __str__(self):
+        average = self.total_wait / self.jobs if self.jobs else 0
+        return (f'{self.running}/{self.limit} running, {len(self.queue)} queued, '
+                f'{average * 1000:.0f} ms average wait, {self.max_wait * 1000:.0f} ms max wait')
+
+
+class ExtractionPool:
+    """Runs ytdl lookups and downloads in worker processes, shared by all guilds.
+
+    Lookups and downloads are queued separately with their own concurrency limits, and
+    interactive jobs are served before background ones. Cancelling a queued job removes it.
+    """
+    INTERACTIVE = 0
+    PREFETCH = 1
+
+    def __init__(self, ytdl_opts, metadata_workers=2, download_workers=2, executor=None):
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(metadata_workers + download_workers, initializer=_init_worker, initargs=(ytdl_opts,))
+        self.executor = executor
+        self.metadata = _PoolLane(metadata_workers)
+        self.downloads = _PoolLane(download_workers)
+        self._sequence = itertools.count()
+
+    def extract_info(self, url, priority=INTERACTIVE, **kwargs):
+        """Extracts info about the given url."""
+        return self.submit(self.metadata, priority, functools.partial(_extract_info, url, **kwargs))
+
+    def extract_playlist(self, url, priority=INTERACTIVE):
+        """Extracts the sparse entries of the playlist at the given url."""
+        return self.submit(self.metadata, priority, functools.partial(_extract_playlist, url))
+
+    def download(self, url, priority=INTERACTIVE):
+        """Downloads the file of the given url."""
+        return self.submit(self.downloads, priority, functools.partial(_download, url))
+
+    def submit(self, lane, priority, func):
+        """Queues a job in the given lane and returns a future of its result."""
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(lane.queue, (priority, next(self._sequence), time.perf_counter(), future, func))
+        self._pump(lane)
+        return future
+
+    def _pump(self, lane):
+        """Starts queued jobs while the lane has free slots."""
+        while lane.running < lane.limit and lane.queue:
+            _, _, enqueued_at, future, func = heapq.heappop(lane.queue)
+            if future.done():
+                continue  # Cancelled while queued
+
+            lane.record_wait(time.perf_counter() - enqueued_at)
+            lane.running += 1
+            work = asyncio.wrap_future(self.executor.submit(func))
+            work.add_done_callback(functools.partial(self._job_done, lane, future))
+
+    def _job_done(self, lane, future, work):
+        """Forwards the result of a job and starts the next ones."""
+        lane.running -= 1
+        if work.cancelled():
+            future.cancel()
+        elif work.exception() is not None:
+            if not future.done():
+                future.set_exception(work.exception())
+        elif not future.done():
+            future.set_result(work.result())
+        self._pump(lane)
+
+    def cancel(self, future):
+        """Cancels a job unless it is already running, since the workers can't be interrupted.
+
+        Returns whether the job is cancelled.
+        """
+        if any(job[3] is future for lane in (self.metadata, self.downloads) for job in lane.queue):
+            future.cancel()
+        return future.cancelled()
+
+    def take_over(self, pool):
+        """Moves the jobs queued in the pool of a previous version of the module to this one, and shuts it down.
+
+        The jobs are bound to the functions of this module, and the jobs running in the previous pool finish there.
+        """
+        for previous_lane, lane in ((pool.metadata, self.metadata), (pool.downloads, self.downloads)):
+            for priority, _, enqueued_at, future, func in sorted(previous_lane.queue, key=lambda job: job[:2]):
+                func = functools.partial(globals()[func.func.__name__], *func.args, **func.keywords)
+                heapq.heappush(lane.queue, (priority, next(self._sequence), enqueued_at, future, func))
+            previous_lane.queue.clear()
+            self._pump(lane)
+        pool.shutdown()
+
+    def shutdown(self):
+        """Cancels the queued jobs and stops the workers."""
+        for lane in (self.metadata, self.downloads):
+            for job in lane.queue:
+                job[3].cancel()
+            lane.queue.clear()
+        self.executor.shutdown(wait=False)
+
+    def __str__(self):
+        return f'lookups: {self.metadata}\ndownloads: {self.downloads}'
+
+
+class MusicTelemetry:
+    """Playback timings of each guild and of all guilds, as rolling histograms."""
+    metrics = {
+        'resolve_seconds': 'Time to resolve a song with ytdl.',
+        'download_seconds': 'Time to download a song.',
+        'download_bytes_per_second': 'Throughput of song downloads.',
+        'queue_wait_seconds': 'Time a song waited in the playlist before being played.',
+        'ffmpeg_spawn_seconds': 'Time to spawn the ffmpeg process of a song.',
+        'first_frame_seconds': 'Time from starting a song to its first audio frame.',
+        'first_audio_seconds': 'Time from a play request on an idle player to its first audio frame.',
+        'song_gap_seconds': 'Silence between the last frame of a song and the first frame of the next.',
+    }
+    throughput_buckets = tuple(2 ** i for i in range(16, 27))
+
+    def __init__(self):
+        self.guilds = collections.defaultdict(dict)
+        self.totals = {}
+
+    def _histogram(self, histograms, metric):
+        if metric not in histograms:
+            buckets = self.throughput_buckets if metric.endswith('_per_second') else metrics.TIME_BUCKETS
+            histograms[metric] = metrics.Histogram(buckets)
+        return histograms[metric]
+
+    def observe(self, guild_id, metric, value):
+        """Records an observation of a metric for a guild."""
+        self._histogram(self.guilds[guild_id], metric).observe(value)
+        self._histogram(self.totals, metric).observe(value)
+
+    def summary(self, guild_id=None):
+        """Returns a representation of the recent timings of a guild, or of all guilds."""
+        histograms = self.totals if guild_id is None else self.guilds.get(guild_id, {})
+        lines = []
+        for metric in self.metrics:
+            if metric not in histograms:
+                continue
+            if metric.endswith('_per_second'):
+                lines.append(f'{metric}: {histograms[metric].summary(1 / 1024, " kB/s")}')
+            else:
+                lines.append(f'{metric}: {histograms[metric].summary(1000, " ms")}')
+        return '\n'.join(lines) or 'No data.'
+
+    def prometheus(self):
+        """Returns the timings of every guild in the Prometheus text format."""
+        lines = []
+        for metric, description in self.metrics.items():
+            name = f'panda_music_{metric}'
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} histogram')
+            for guild_id, histograms in self.guilds.items():
+                if metric in histograms:
+                    lines.extend(histograms[metric].prometheus(name, {'guild': guild_id}))
+        return '\n'.join(lines) + '\n'
+
+
+class PrefetchScheduler:
+    """Downloads the next songs of the guilds' playlists ahead of time, shared by all guilds.
+
+    Only the first `lookahead` songs of each playlist are prefetched, those closest to being
+    played first, and at most `max_downloads` prefetches run at once across all guilds.
+    """
+
+    def __init__(self, pool, cache, resolutions, telemetry, lookahead=2, max_downloads=4):
+        self.pool = pool
+        self.cache = cache
+        self.resolutions = resolutions
+        self.telemetry = telemetry
+        self.lookahead = lookahead
+        self.max_downloads = max_downloads
+        self.playlists = set()
+        self.tasks = {}  # SongInfo -> (playlist, task)
+        self.failed = weakref.WeakSet()
+
+    def update(self, playlist):
+        """Reschedules the prefetches after a change of the playlist."""
+        # Stop waiting on songs that left the playlist, their download is cancelled once unreferenced
+        for song, (song_playlist, task) in list(self.tasks.items()):
+            if song_playlist is playlist and song not in playlist:
+                task.cancel()
+                del self.tasks[song]
+
+        self.playlists.add(playlist)
+        self._fill()
+
+    def _candidates(self, playlist):
+        """Yields the songs of a playlist that need prefetching, with their position."""
+        for position, song in enumerate(itertools.islice(playlist, self.lookahead)):
+            if not song.local_file and not song.downloaded.is_set() and song not in self.tasks and song not in self.failed:
+                yield position, song
+
+    def _fill(self):
+        """Starts prefetches until the concurrency budget is used up."""
+        while len(self.tasks) < self.max_downloads:
+            candidates = []
+            for playlist in list(self.playlists):
+                playlist_candidates = list(self._candidates(playlist))
+                if playlist_candidates:
+                    candidates.append((*playlist_candidates[0], playlist))
+                else:
+                    self.playlists.discard(playlist)
+
+            if not candidates:
+                break
+
+            # Serve the songs closest to the head of their playlist first
+            _, song, playlist = min(candidates, key=lambda c: c[0])
+            task = asyncio.ensure_future(self.prefetch(song, ExtractionPool.PREFETCH))
+            task.add_done_callback(functools.partial(self._prefetch_done, song))
+            self.tasks[song] = (playlist, task)
+
+    def _prefetch_done(self, song, task):
+        """Frees the slot of a finished prefetch."""
+        if self.tasks.get(song, (None, None))[1] is task:
+            del self.tasks[song]
+        if not task.cancelled() and task.exception() is not None:
+            # Leave it to the download before playing to try again
+            self.failed.add(song)
+            log.warning(f'Prefetch of {song.filename} failed: {task.exception()}')
+        self._fill()
+
+    async def prefetch(self, song, priority):
+        """Resolves the song if it was created from a playlist entry and downloads it."""
+        await self.resolve(song, priority)
+
+        elapsed = await song.download(self.pool, self.cache, priority)
+        if elapsed is not None and os.path.exists(song.filename):
+            size = os.path.getsize(song.filename)
+            self.telemetry.observe(song.channel.guild.id, 'download_seconds', elapsed)
+            self.telemetry.observe(song.channel.guild.id, 'download_bytes_per_second', size / max(elapsed, 1e-3))
+            log.info(f'Downloaded {song.filename} ({size / 1048576:.2f} Mb) in {elapsed:.2f} s')
+
+    async def resolve(self, song, priority):
+        """Resolves the song if it was created from a playlist entry."""
+        if song.resolved:
+            return
+
+        started_at = time.perf_counter()
+        await song.resolve_entry(self.pool, self.cache, self.resolutions, priority)
+        self.telemetry.observe(song.channel.guild.id, 'resolve_seconds', time.perf_counter() - started_at)
+
+    async def resolve_now(self, song):
+        """Resolves a song that is about to be played, joining its prefetch if any."""
+        await self.resolve(song, ExtractionPool.INTERACTIVE)
+
+    async def download_now(self, song):
+        """Downloads a song that is about to be played, joining its prefetch if any."""
+        if not song.downloaded.is_set():
+            await self.prefetch(song, ExtractionPool.INTERACTIVE)
 
-    def __init__(self, song_info, volume=1.0):
+    def shutdown(self):
+        """Cancels all the prefetches."""
+        for _, task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.playlists.clear()
+
+
+class Song(discord.AudioSource):
+    """Represents a song to play.
+
+    When streaming, the song is read from its media url until its file has been downloaded.
+    With opus passthrough, ffmpeg encodes the audio and applies the volume itself, which
+    spares the bot from scaling and encoding every frame.
+    """
+
+    def __init__(self, song_info, volume=1.0, position=0, stream=False, opus=False):
+        self.started_at = time.perf_counter()
+        self.song_info = song_info
         self.info = song_info.info
         self.requester = song_info.requester
         self.channel = song_info.channel
         self.filename = song_info.filename
-        super().__init__(discord.FFmpegPCMAudio(self.filename, options='-vn'), volume=volume)
+        self.requested_at = song_info.requested_at
+        self.position = position
+        self.frames = 0
+        self.first_frame_at = None
+        self.last_frame_at = None
+        self.on_first_frame = None  # Called from the audio thread
+        self.streamed = stream and song_info.streamable and not song_info.downloaded.is_set()
+        self.opus = opus
+        self._volume = volume
+
+        before_options = [f'-ss {position:.2f}'] if position else []
+        if self.streamed:
+            # Let ffmpeg reconnect on its own when the connection drops
+            before_options.append('-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5')
+            headers = ''.join(f'{k}: {v}\r\n' for k, v in self.info.get('http_headers', {}).items())
+            if headers:
+                before_options.append(f'-headers {shlex.quote(headers)}')
+            source = self.info['url']
+        else:
+            source = self.filename
+        before_options = ' '.join(before_options) or None
+
+        if not opus:
+            self.source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(source, before_options=before_options, options='-vn'), volume=volume)
+        elif volume == 1.0 and self.info.get('acodec') == 'opus':
+            # Already encoded in opus, ffmpeg only has to remux it
+            self.source = discord.FFmpegOpusAudio(source, codec='opus', before_options=before_options, options='-vn')
+        else:
+            self.source = discord.FFmpegOpusAudio(source, before_options=before_options, options=f'-vn -filter:a volume={volume}')
+
+    @property
+    def volume(self):
+        """Returns the volume of the song."""
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        """Sets the volume of the song, opus passthrough songs have to be restarted to apply it."""
+        self._volume = value
+        if not self.opus:
+            self.source.volume = value
+
+    @property
+    def elapsed(self):
+        """Returns the position reached in the song, in seconds."""
+        return self.position + self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+    def ended_early(self):
+        """Indicates if the song stopped before reaching its end."""
+        return 'duration' in self.info and self.elapsed < self.info['duration'] - 1
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+    def read(self):
+        data = self.source.read()
+        if data:
+            self.frames += 1
+            self.last_frame_at = time.perf_counter()
+            if self.first_frame_at is None:
+                self.first_frame_at = self.last_frame_at
+                if self.on_first_frame is not None:
+                    self.on_first_frame()
+        return data
 
     def __str__(self):
-        title = f"**{self.info['title']}**"
-        creator = f"**{self.info.get('creator') or self.info['uploader']}**"
-        duration = f" (duration: {duration_to_str(self.info['duration'])})" if 'duration' in self.info else ''
-        return f'{title} from {creator}{duration}'
+        return str(self.song_info)
+
+
+class _LazyYoutubeDL:
+    """Class attribute creating the class' YoutubeDL instance on first access."""
+
+    def __get__(self, instance, owner):
+        ytdl = youtube_dl.YoutubeDL(owner.ytdl_opts)
+        owner.ytdl = ytdl  # Replaces this descriptor
+        return ytdl
 
 
 class SongInfo:
     """Represents a Song's info."""
     ytdl_opts = {
         'default_search': 'auto',
-        'format': 'bestaudio/best',
+        'format': 'bestaudio[acodec=opus]/bestaudio/best',
         'ignoreerrors': True,
         'source_address': '0.0.0.0',
         'nocheckcertificate': True,
@@ -64,21 +746,43 @@ class SongInfo:
         'logtostderr': False,
         'no_warnings': True,
         'quiet': True,
-        'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
+        'outtmpl': 'cache/music/%(extractor)s-%(id)s.%(ext)s',
         'noplaylist': True
     }
-    ytdl = youtube_dl.YoutubeDL(ytdl_opts)
+    ytdl = _LazyYoutubeDL()
 
-    def __init__(self, info, requester, channel):
+    def __init__(self, info, requester, channel, resolved=True):
         self.info = info
         self.requester = requester
         self.channel = channel
-        self.filename = info.get('_filename', self.ytdl.prepare_filename(self.info))
         self.downloaded = asyncio.Event()
         self.local_file = '_filename' in info
+        self.requested_at = None
+        self.resolved = resolved
+        self.held = False  # Whether a playlist holds a reference on the song's cached file
+        self.queued_at = None
+        self._resolving = None
+        self.filename = None
+        self.cache_key = None
+        if resolved:
+            self._set_filename()
+
+    def _set_filename(self):
+        """Sets the song's filename and cache key from its full info."""
+        self.filename = self.info.get('_filename') or self.ytdl.prepare_filename(self.info)
+
+        # Downloaded files are named after their extractor and id, which makes their stem a stable cache key
+        self.cache_key = None if self.local_file else pathlib.Path(self.filename).stem
+
+    def __str__(self):
+        title = f"**{self.info.get('title') or self.info.get('url')}**"
+        creator = self.info.get('creator') or self.info.get('uploader')
+        creator = f' from **{creator}**' if creator else ''
+        duration = f" (duration: {duration_to_str(int(self.info['duration']))})" if self.info.get('duration') else ''
+        return f'{title}{creator}{duration}'
 
     @classmethod
-    async def create(cls, query, requester, channel, loop=None):
+    async def create(cls, query, requester, channel, pool, resolutions=None, priority=ExtractionPool.INTERACTIVE):
         """Class method to create a SongInfo."""
         try:
             # Path.is_file() can throw a OSError on syntactically incorrect paths, like urls.
@@ -87,7 +791,7 @@ class SongInfo:
         except OSError:
             pass
 
-        return await cls.from_ytdl(query, requester, channel, loop=loop)
+        return await cls.from_ytdl(query, requester, channel, pool, resolutions=resolutions, priority=priority)
 
     @classmethod
     def from_file(cls, file, requester, channel):
@@ -104,13 +808,27 @@ class SongInfo:
         return cls(info, requester, channel)
 
     @classmethod
-    async def from_ytdl(cls, request, requester, channel, loop=None):
-        """Class method to create a SongInfo using ytdl."""
-        loop = loop or asyncio.get_event_loop()
+    def from_entry(cls, entry, requester, channel):
+        """Class method to create a SongInfo from a sparse playlist entry, resolved later on."""
+        return cls(entry, requester, channel, resolved=False)
+
+    @classmethod
+    async def from_ytdl(cls, request, requester, channel, pool, resolutions=None, priority=ExtractionPool.INTERACTIVE):
+        """Class method to create a SongInfo using ytdl.
+
+        If a ResolutionCache is given, it is used to memoize the resolution of the request.
+        """
+        if resolutions is None:
+            info = await cls.resolve(request, pool, priority=priority)
+        else:
+            info = await resolutions.resolve(request, lambda: cls.resolve(request, pool, resolutions, priority))
+        return cls(info, requester, channel)
 
+    @classmethod
+    async def resolve(cls, request, pool, resolutions=None, priority=ExtractionPool.INTERACTIVE):
+        """Class method to resolve the full info of a request using ytdl."""
         # Get sparse info about our query
-        partial = functools.partial(cls.ytdl.extract_info, request, download=False, process=False)
-        sparse_info = await loop.run_in_executor(None, partial)
+        sparse_info = await pool.extract_info(request, priority, download=False, process=False)
 
         if sparse_info is None:
             raise MusicError(f'Could not retrieve info from input : {request}')
@@ -127,13 +845,22 @@ class SongInfo:
             if info_to_process is None:
                 raise MusicError(f'Could not retrieve info from input : {request}')
 
-        # Process full video info
+        # Process full video info, unless that video has already been resolved
         url = info_to_process.get('url', info_to_process.get('webpage_url', info_to_process.get('id')))
-        partial = functools.partial(cls.ytdl.extract_info, url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        if resolutions is not None:
+            found, info = resolutions.get(url)
+            if found and info is not None:
+                return info
+
+        return await cls.process(url, pool, priority)
+
+    @classmethod
+    async def process(cls, url, pool, priority=ExtractionPool.INTERACTIVE, **kwargs):
+        """Class method to process the full info of a url using ytdl."""
+        processed_info = await pool.extract_info(url, priority, download=False, **kwargs)
 
         if processed_info is None:
-            raise MusicError(f'Could not retrieve info from input : {request}')
+            raise MusicError(f'Could not retrieve info from url : {url}')
 
         # Select the first search result if any
         if "entries" not in processed_info:
@@ -144,70 +871,193 @@ class SongInfo:
                 try:
                     info = processed_info['entries'].pop(0)
                 except IndexError:
-                    raise MusicError(f'Could not retrieve info from url : {info_to_process["url"]}')
+                    raise MusicError(f'Could not retrieve info from url : {url}')
 
-        return cls(info, requester, channel)
+        return info
+
+    async def resolve_entry(self, pool, cache, resolutions=None, priority=ExtractionPool.INTERACTIVE):
+        """Resolves the full info of a song created from a playlist entry.
+
+        Concurrent calls share a single resolution.
+        """
+        if self.resolved:
+            return
+
+        if self._resolving is None:
+            self._resolving = asyncio.ensure_future(self._resolve_entry(pool, cache, resolutions, priority))
+        try:
+            await asyncio.shield(self._resolving)
+        except MusicError:
+            self._resolving = None
+            raise
+
+    async def _resolve_entry(self, pool, cache, resolutions, priority):
+        url = self.info.get('url') or self.info.get('webpage_url') or self.info['id']
+        kwargs = {'ie_key': self.info['ie_key']} if 'ie_key' in self.info else {}
+        resolve = functools.partial(self.process, url, pool, priority, **kwargs)
+
+        # Bare ids are case sensitive and can't be told apart by the resolution cache
+        if resolutions is not None and '://' in url:
+            info = await resolutions.resolve(url, resolve)
+        else:
+            info = await resolve()
+
+        self.info = info
+        self.resolved = True
+        self._set_filename()
+        if self.held:
+            cache.acquire(self.cache_key)
 
-    async def download(self, loop):
-        """Downloads the song file with ytdl."""
-        if not pathlib.Path(self.filename).exists():
-            partial = functools.partial(self.ytdl.extract_info, self.info['webpage_url'], download=True)
-            self.info = await loop.run_in_executor(None, partial)
+    async def download(self, pool, cache, priority=ExtractionPool.INTERACTIVE):
+        """Downloads the song file with ytdl, unless it is already cached.
+
+        Returns the time spent downloading if this call did download the file, None otherwise.
+        Raises MusicError if the download failed.
+        """
+        async def download():
+            job = pool.download(self.info['webpage_url'], priority)
+            try:
+                succeeded = await asyncio.shield(job)
+            except asyncio.CancelledError:
+                if not pool.cancel(job):
+                    # Workers can't be interrupted, the file is still written and must count in the cache's budget
+                    cache.add_when_done(self.cache_key, self.filename, job)
+                raise
+
+            # ytdl ignores errors, a failed download only shows in the result
+            if not succeeded:
+                raise MusicError(f'Could not download {self}.')
+
+        elapsed = None
+        if not self.local_file:
+            elapsed = await cache.fetch(self.cache_key, self.filename, download)
+            # Files are cached by stem, the cached one may be of another format than the resolved one
+            self.filename = cache.filename(self.cache_key) or self.filename
         self.downloaded.set()
+        return elapsed
+
+    @property
+    def streamable(self):
+        """Indicates if the song can be played from its media url."""
+        return self.resolved and not self.local_file and 'url' in self.info
 
     async def wait_until_downloaded(self):
         """Helper function to wait until the song file has been downloaded."""
         await self.downloaded.wait()
 
 
-class Playlist(asyncio.Queue):
-    """Represents a playlist."""
+class Playlist:
+    """Represents a playlist.
+
+    Queued songs are kept in a set for constant time membership tests, and hold a reference
+    on their cached file until they are removed or done playing.
+    """
+
+    def __init__(self, cache, *, maxsize=0):
+        self.cache = cache
+        self.maxsize = maxsize
+        self._songs = collections.deque()
+        self._members = set()
 
     def __iter__(self):
-        return self._queue.__iter__()
+        return iter(self._songs)
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __contains__(self, song):
+        return song in self._members
+
+    def empty(self):
+        """Indicates if the playlist is empty."""
+        return not self._songs
+
+    def full(self):
+        """Indicates if the playlist is full."""
+        return 0 < self.maxsize <= len(self._songs)
+
+    def _release(self, song):
+        self._members.discard(song)
+        song.held = False
+        self.cache.release(song.cache_key)
 
     def clear(self):
         """Clears the playlist from its items."""
-        for song in self._queue:
-            os.remove(song.filename)
-        self._queue.clear()
+        for song in self._songs:
+            self._release(song)
+        self._songs.clear()
 
     def get_song(self):
-        """Gets the first item of the playlist."""
-        return self.get_nowait()
+        """Gets the first item of the playlist, which keeps its reference until done playing."""
+        song = self._songs.popleft()
+        self._members.discard(song)
+        return song
 
     def add_song(self, song):
         """Adds an item to the playlist."""
-        self.put_nowait(song)
-
-    def __str__(self):
-        info = 'Current playlist:\n'
-        info_len = len(info)
-
-        for song in self:
-            song_repr = f'{song}\n'
-            song_repr_len = len(song_repr)
-
-            if info_len + song_repr_len > 1995:
-                info += '[...]'
-                break
+        if self.full():
+            raise MusicError('Playlist is full, try again later.')
 
-            info += song_repr
-            info_len += song_repr_len
+        song.queued_at = time.perf_counter()
+        self._songs.append(song)
+        self._members.add(song)
+        song.held = True
+        self.cache.acquire(song.cache_key)
+
+    def remove(self, position):
+        """Removes and returns the item at the given position."""
+        song = self._songs[position]
+        del self._songs[position]
+        self._release(song)
+        return song
+
+    def move(self, position, new_position):
+        """Moves the item at the given position to a new position."""
+        song = self._songs[position]
+        del self._songs[position]
+        self._songs.insert(new_position, song)
+        return song
+
+    def shuffle(self):
+        """Shuffles the items of the playlist."""
+        songs = list(self._songs)
+        random.shuffle(songs)
+        self._songs = collections.deque(songs)
+
+    def page(self, number, per_page=10):
+        """Returns the representation of a page of the playlist, pages start at 1."""
+        pages = max(1, math.ceil(len(self) / per_page))
+        number = min(max(number, 1), pages)
+        start = (number - 1) * per_page
+
+        lines = [f'Current playlist (page {number}/{pages}):']
+        lines.extend(f'**#{position}** {song}' for position, song in enumerate(itertools.islice(self._songs, start, start + per_page), start + 1))
+        if self.empty():
+            lines.append('Empty.')
+        return '\n'.join(lines)
 
-        return info
+    def __str__(self):
+        return self.page(1)
 
 
 class GuildMusicState:
     """The music state of a guild."""
 
-    def __init__(self, loop):
-        self.playlist = Playlist(maxsize=50)
+    def __init__(self, guild_id, loop, cache, prefetcher, telemetry, stream=False, opus=False):
+        self.guild_id = guild_id
+        self.playlist = Playlist(cache, maxsize=50)
+        self.cache = cache
+        self.prefetcher = prefetcher
+        self.telemetry = telemetry
+        self.song_ended_at = None
+        self.stream = stream
+        self.opus = opus
         self.voice_client = None
         self.loop = loop
         self.player_volume = 0.5
         self.skips = set()
         self.min_skips = 5
+        self.skipping = False
 
     @property
     def current_song(self):
@@ -223,12 +1073,64 @@ class GuildMusicState:
     def volume(self, value):
         """Sets the volume of the audio player."""
         self.player_volume = value
-        if self.voice_client:
-            self.voice_client.source.volume = value
+        if self.voice_client and self.voice_client.source:
+            song = self.current_song
+            if song.opus:
+                # The volume is applied by ffmpeg, restart the song where it is
+                self.voice_client.source = Song(song.song_info, value, position=song.elapsed, stream=self.stream, opus=True)
+                # Leave the player time to finish any read of the previous source
+                self.loop.call_later(1, song.cleanup)
+            else:
+                song.volume = value
+
+    def add_song(self, song):
+        """Adds a song to the playlist."""
+        self.playlist.add_song(song)
+        self.prefetcher.update(self.playlist)
+
+    def add_songs(self, songs):
+        """Adds songs to the playlist until it is full, returns how many were added."""
+        added = 0
+        for song in songs:
+            if self.playlist.full():
+                break
+            self.playlist.add_song(song)
+            added += 1
+        self.prefetcher.update(self.playlist)
+        return added
+
+    def clear(self):
+        """Clears the playlist."""
+        self.playlist.clear()
+        self.prefetcher.update(self.playlist)
+
+    def remove(self, position):
+        """Removes a song from the playlist, positions start at 1."""
+        song = self.playlist.remove(self._index(position))
+        self.prefetcher.update(self.playlist)
+        return song
+
+    def move(self, position, new_position):
+        """Moves a song to another position of the playlist, positions start at 1."""
+        song = self.playlist.move(self._index(position), self._index(new_position))
+        self.prefetcher.update(self.playlist)
+        return song
+
+    def shuffle(self):
+        """Shuffles the playlist."""
+        self.playlist.shuffle()
+        self.prefetcher.update(self.playlist)
+
+    def _index(self, position):
+        """Converts a position in the playlist to an index."""
+        if not 1 <= position <= len(self.playlist):
+            raise MusicError(f'There is no song in position #{position}.')
+        return position - 1
 
     async def stop(self):
         """Clears the playlist and stops the player."""
-        self.playlist.clear()
+        self.clear()
+        self.song_ended_at = None
         if self.voice_client:
             await self.voice_client.disconnect()
             self.voice_client = None
@@ -237,21 +1139,83 @@ class GuildMusicState:
         """Indicates if we're currently playing audio."""
         return self.voice_client and self.voice_client.is_playing()
 
+    def skip(self):
+        """Stops the current song to play the next one."""
+        self.skips.clear()
+        self.skipping = True
+        # Stopping drops the player and its source, the end of the song is only known until then
+        if self.current_song is not None:
+            self.song_ended_at = self.current_song.last_frame_at
+        self.voice_client.stop()
+
+    def play_song(self, song_info, position=0):
+        """Starts playing a song, optionally from a given position in seconds."""
+        self.skipping = False
+        started_at = time.perf_counter()
+        source = Song(song_info, self.player_volume, position=position, stream=self.stream, opus=self.opus)
+        self.telemetry.observe(self.guild_id, 'ffmpeg_spawn_seconds', time.perf_counter() - started_at)
+        source.on_first_frame = lambda: self.loop.call_soon_threadsafe(self._first_frame, source)
+        self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next_song(song_info, e), self.loop).result())
+        return source
+
+    def _first_frame(self, source):
+        """Records the timings of a song that just started playing."""
+        self.telemetry.observe(self.guild_id, 'first_frame_seconds', source.first_frame_at - source.started_at)
+        if self.song_ended_at is not None:
+            self.telemetry.observe(self.guild_id, 'song_gap_seconds', source.first_frame_at - self.song_ended_at)
+        elif source.requested_at is not None and source.position == 0:
+            # The song started an idle player, comparable between streaming and downloading first
+            first_audio = source.first_frame_at - source.requested_at
+            self.telemetry.observe(self.guild_id, 'first_audio_seconds', first_audio)
+            mode = 'stream' if source.streamed else 'download'
+            log.info(f'Time to first audio for {source.info.get("webpage_url", source.filename)}: {first_audio * 1000:.0f} ms ({mode})')
+        self.song_ended_at = None
+
     async def play_next_song(self, song=None, error=None):
         """Callback called after the voice_client has finished playing a source."""
         if error:
             await self.current_song.channel.send(f'An error has occurred while playing {self.current_song}: {error}')
 
-        if song and not song.local_file and song.filename not in [s.filename for s in self.playlist]:
-            os.remove(song.filename)
+        if song and self.voice_client and self.current_song:
+            self.song_ended_at = self.current_song.last_frame_at
+
+        # A stream cut short picks up where it stopped from the downloaded file
+        if song and self.voice_client and self.current_song and not self.skipping and self.current_song.streamed and self.current_song.ended_early() and song.downloaded.is_set():
+            log.info(f'Stream of {song.filename} ended early, resuming from the downloaded file')
+            self.play_song(song, position=self.current_song.elapsed)
+            return
+
+        if song:
+            song.held = False
+            self.cache.release(song.cache_key)
 
         if self.playlist.empty():
             await self.stop()
         else:
             next_song_info = self.playlist.get_song()
-            await next_song_info.wait_until_downloaded()
-            source = Song(next_song_info, self.player_volume)
-            self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next_song(next_song_info, e), self.loop).result())
+            self.prefetcher.update(self.playlist)
+            self.telemetry.observe(self.guild_id, 'queue_wait_seconds', time.perf_counter() - next_song_info.queued_at)
+
+            # Songs queued from a playlist are only resolved now
+            try:
+                await self.prefetcher.resolve_now(next_song_info)
+            except MusicError as e:
+                await next_song_info.channel.send(f'Skipping {next_song_info}: {e}')
+                await self.play_next_song(next_song_info)
+                return
+
+            # Download the song and play it, or stream it while it downloads
+            download = self.prefetcher.download_now(next_song_info)
+            if self.stream and next_song_info.streamable:
+                self.loop.create_task(download)
+            else:
+                try:
+                    await download
+                except MusicError as e:
+                    await next_song_info.channel.send(f'Skipping {next_song_info}: {e}')
+                    await self.play_next_song(next_song_info)
+                    return
+            source = self.play_song(next_song_info)
             await next_song_info.channel.send(f'Now playing {source}.')
 
 
@@ -260,12 +1224,87 @@ class Music(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.music_states = {}
+        self.conf = bot.conf.get('music', {})
+        self.stream = self.conf.get('stream', False)
+        self.opus = self.conf.get('opus', False)
+
+        # Split the bandwidth budget between the download workers
+        # The pool is never handed over, the workers of a previous one run the functions of the previous module
+        ytdl_opts = SongInfo.ytdl_opts.copy()
+        download_workers = self.conf.get('download_workers', 2)
+        if 'bandwidth' in self.conf:
+            ytdl_opts['ratelimit'] = self.conf['bandwidth'] // download_workers
+        self.pool = ExtractionPool(ytdl_opts, self.conf.get('metadata_workers', 2), download_workers)
+
+        # Keep playing through a reload
+        if not handoff.claim(bot, self, HANDOFF_VERSION, self.adopt_state):
+            self.music_states = {}
+            self.cache = AudioCache(os.path.dirname(SongInfo.ytdl_opts['outtmpl']), self.conf.get('cache_size', 2 << 30))
+            self.resolutions = ResolutionCache(self.conf.get('resolve_ttl', 3600), self.conf.get('resolve_negative_ttl', 30))
+            self.telemetry = MusicTelemetry()
+            self.prefetcher = PrefetchScheduler(self.pool, self.cache, self.resolutions, self.telemetry, self.conf.get('prefetch_lookahead', 2), self.conf.get('prefetch_downloads', 4))
+
+        # Periodically dump the telemetry for Prometheus' textfile collector
+        self.metrics_task = None
+        if 'metrics_file' in self.conf:
+            self.metrics_task = self.bot.loop.create_task(self.dump_metrics(self.conf['metrics_file'], self.conf.get('metrics_interval', 15)))
+
+    async def dump_metrics(self, file, interval):
+        """Writes the telemetry to a file in the Prometheus text format at a fixed interval."""
+        while True:
+            await self.bot.loop.run_in_executor(None, metrics.write_atomically, file, self.telemetry.prometheus())
+            await asyncio.sleep(interval)
 
     def cog_unload(self):
         """Handles special unloading."""
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+
+        state = {
+            'music_states': self.music_states,
+            'cache': self.cache,
+            'resolutions': self.resolutions,
+            'pool': self.pool,
+            'telemetry': self.telemetry,
+            'prefetcher': self.prefetcher,
+        }
+        if not handoff.offer(self.bot, self, HANDOFF_VERSION, state, self.teardown):
+            self.teardown()
+
+    def teardown(self):
+        """Stops the players and the workers."""
         for state in self.music_states.values():
             self.bot.loop.create_task(state.stop())
+        self.prefetcher.shutdown()
+        self.pool.shutdown()
+
+    def adopt_state(self, state):
+        """Takes over the caches, players and queued extraction jobs of the previous instance of the cog.
+
+        The objects are made instances of the reloaded classes, so that the players already
+        running pick up the changes.
+        """
+        self.cache = handoff.adopt(state['cache'], AudioCache)
+        self.resolutions = handoff.adopt(state['resolutions'], ResolutionCache)
+        self.telemetry = handoff.adopt(state['telemetry'], MusicTelemetry)
+        self.prefetcher = handoff.adopt(state['prefetcher'], PrefetchScheduler)
+        self.prefetcher.pool = self.pool
+
+        music_states = {}
+        for guild_id, music_state in state['music_states'].items():
+            music_state = handoff.adopt(music_state, GuildMusicState)
+            handoff.adopt(music_state.playlist, Playlist)
+            for song_info in music_state.playlist:
+                handoff.adopt(song_info, SongInfo)
+            if music_state.voice_client is not None and music_state.voice_client.source is not None:
+                song = handoff.adopt(music_state.current_song, Song)
+                handoff.adopt(song.song_info, SongInfo)
+            music_state.stream = self.stream
+            music_state.opus = self.opus
+            music_states[guild_id] = music_state
+        self.music_states = music_states
+
+        self.pool.take_over(state['pool'])
 
     def cog_check(self, ctx):
         """Extra checks for the cog's commands."""
@@ -275,7 +1314,7 @@ class Music(commands.Cog):
 
     async def cog_before_invoke(self, ctx):
         """Pre invoke hook for the cog's commands."""
-        ctx.music_state = self.music_states.setdefault(ctx.guild.id, GuildMusicState(self.bot.loop))
+        ctx.music_state = self.music_states.setdefault(ctx.guild.id, GuildMusicState(ctx.guild.id, self.bot.loop, self.cache, self.prefetcher, self.telemetry, self.stream, self.opus))
 
     async def cog_command_error(self, ctx, error):
         """Error handler for the cog's commands."""
@@ -297,9 +1336,9 @@ class Music(commands.Cog):
             await ctx.send('Not playing.')
 
     @commands.command()
-    async def playlist(self, ctx):
-        """Shows info about the current playlist."""
-        await ctx.send(f'{ctx.music_state.playlist}')
+    async def playlist(self, ctx, page: int = 1):
+        """Shows a page of the current playlist."""
+        await ctx.send(ctx.music_state.playlist.page(page))
 
     @commands.command()
     @commands.has_permissions(manage_guild=True)
@@ -325,29 +1364,28 @@ class Music(commands.Cog):
         Automatically searches with youtube_dl
         List of supported sites : https://ytdl-org.github.io/youtube-dl/supportedsites.html
         """
+        requested_at = time.perf_counter()
         await ctx.message.add_reaction('\N{HOURGLASS}')
 
         # Create the SongInfo
-        song = await SongInfo.create(request, ctx.author, ctx.channel, loop=ctx.bot.loop)
+        song = await SongInfo.create(request, ctx.author, ctx.channel, self.pool, resolutions=self.resolutions)
+        self.telemetry.observe(ctx.guild.id, 'resolve_seconds', time.perf_counter() - requested_at)
 
         # Connect to the voice channel if needed
         if ctx.voice_client is None or not ctx.voice_client.is_connected():
             await ctx.invoke(self.join)
 
+        # Only a song starting an idle player measures the time to first audio, queued ones wait on the others
+        if not ctx.music_state.is_playing() and ctx.music_state.playlist.empty():
+            song.requested_at = requested_at
+
         # Add the info to the playlist
-        try:
-            ctx.music_state.playlist.add_song(song)
-        except asyncio.QueueFull:
-            raise MusicError('Playlist is full, try again later.')
+        ctx.music_state.add_song(song)
 
         if not ctx.music_state.is_playing():
-            # Download the song and play it
-            await song.download(ctx.bot.loop)
             await ctx.music_state.play_next_song()
         else:
-            # Schedule the song's download
-            ctx.bot.loop.create_task(song.download(ctx.bot.loop))
-            await ctx.send(f'Queued {song} in position **#{ctx.music_state.playlist.qsize()}**')
+            await ctx.send(f'Queued {song} in position **#{len(ctx.music_state.playlist)}**')
 
         await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
         await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
@@ -358,6 +1396,46 @@ class Music(commands.Cog):
         await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
         await ctx.message.add_reaction('\N{CROSS MARK}')
 
+    @commands.command()
+    async def playall(self, ctx, *, request: str):
+        """Adds all the songs of a remote playlist to the playlist.
+
+        The songs are only looked up when they are about to be played.
+        """
+        await ctx.message.add_reaction('\N{HOURGLASS}')
+        progress = await ctx.send('Fetching the playlist...')
+
+        playlist_info = await self.pool.extract_playlist(request)
+        if playlist_info is None or 'entries' not in playlist_info:
+            raise MusicError(f'Could not retrieve a playlist from input : {request}')
+
+        entries = [entry for entry in playlist_info['entries'] if entry is not None]
+        title = playlist_info.get('title') or request
+        await progress.edit(content=f'Queuing {len(entries)} songs from **{title}**...')
+
+        # Connect to the voice channel if needed
+        if ctx.voice_client is None or not ctx.voice_client.is_connected():
+            await ctx.invoke(self.join)
+
+        added = ctx.music_state.add_songs(SongInfo.from_entry(entry, ctx.author, ctx.channel) for entry in entries)
+        if added == 0:
+            raise MusicError('Playlist is full, try again later.')
+
+        skipped = f', {len(entries) - added} skipped as the playlist is full' if added < len(entries) else ''
+        await progress.edit(content=f'Queued {added} songs from **{title}**{skipped}.')
+
+        if not ctx.music_state.is_playing():
+            await ctx.music_state.play_next_song()
+
+        await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
+        await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
+
+    @playall.error
+    async def playall_error(self, ctx, error):
+        """Error handler for the `playall` command."""
+        await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
+        await ctx.message.add_reaction('\N{CROSS MARK}')
+
     @commands.command()
     @commands.has_permissions(manage_guild=True)
     async def pause(self, ctx):
@@ -388,7 +1466,25 @@ class Music(commands.Cog):
     @commands.command()
     async def clear(self, ctx):
         """Clears the playlist."""
-        ctx.music_state.playlist.clear()
+        ctx.music_state.clear()
+
+    @commands.command()
+    async def remove(self, ctx, position: int):
+        """Removes the song in the given position from the playlist."""
+        song = ctx.music_state.remove(position)
+        await ctx.send(f'Removed {song} from the playlist.')
+
+    @commands.command()
+    async def move(self, ctx, position: int, new_position: int):
+        """Moves the song in the given position to a new position of the playlist."""
+        song = ctx.music_state.move(position, new_position)
+        await ctx.send(f'Moved {song} to position **#{new_position}**.')
+
+    @commands.command()
+    async def shuffle(self, ctx):
+        """Shuffles the playlist."""
+        ctx.music_state.shuffle()
+        await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
     @commands.command()
     async def skip(self, ctx):
@@ -408,8 +1504,19 @@ class Music(commands.Cog):
 
         # Check if the song has to be skipped
         if len(ctx.music_state.skips) > ctx.music_state.min_skips or ctx.author == ctx.music_state.current_song.requester:
-            ctx.music_state.skips.clear()
-            ctx.voice_client.stop()
+            ctx.music_state.skip()
+
+    @commands.command()
+    @commands.is_owner()
+    async def musicstats(self, ctx, scope='guild'):
+        """Shows the state of the shared caches and workers, and the playback timings.
+
+        The timings are those of the current guild, or of all guilds if the scope is `all`.
+
+        Only the bot owner can use this command.
+        """
+        timings = self.telemetry.summary(None if scope == 'all' else ctx.guild.id)
+        await ctx.send(f'Audio cache: {self.cache}\nResolution cache: {self.resolutions}\nExtraction pool:\n{self.pool}\nTimings:\n{timings}')
 
     @commands.command()
     @commands.has_permissions(manage_guild=True)
@@ -1,10 +1,19 @@
+import asyncio
+import collections
+import json
 import logging
+import math
+import os
+import random
+import time
 
 import discord
 import discord.ext.commands as commands
 import peony
 
 import config
+import handoff
+import metrics
 
 log = logging.getLogger(__name__)
 logging.getLogger('peony').setLevel(logging.WARNING)
@@ -25,19 +34,687 @@ def build_tweet_url(screen_name, tweet_id):
     return f'https://twitter.com/{screen_name}/status/{tweet_id}'
 
 
+class Follow(config.Record):
+    """A followed user, and the channels their tweets are sent to."""
+    __slots__ = ('screen_name', 'channels')
+
+
+class Checkpoint(config.Record):
+    """The latest tweet sent to a channel."""
+    __slots__ = ('last_tweet_id',)
+
+
+# Version of the state handed over on reload, bump it when that state changes shape so that reloads start cold
+HANDOFF_VERSION = 2
+
+# Followed users and their channels are mapped by id
+CONF_SCHEMA = config.Schema(int_keys=('follows', 'channels'), records={'follows': Follow, 'channels': Checkpoint})
+
+
+class TokenBucket:
+    """Rate limiter allowing bursts of `rate` operations, refilled over `per` seconds."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+
+    async def acquire(self):
+        """Waits until an operation is allowed."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate / self.per)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class FanOut:
+    """Sends messages to Discord channels concurrently.
+
+    Sends are bounded globally and rate limited per channel and per guild. Failed sends are
+    retried with an exponential backoff, and a channel failing never affects the others.
+    """
+
+    def __init__(self, bot, concurrency=20, retries=3, channel_rate=(5, 5), guild_rate=(20, 5)):
+        self.bot = bot
+        self.retries = retries
+        self.channel_rate = channel_rate
+        self.guild_rate = guild_rate
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.channel_buckets = {}
+        self.guild_buckets = {}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _bucket(self, buckets, key, rate):
+        if key not in buckets:
+            buckets[key] = TokenBucket(*rate)
+        return buckets[key]
+
+    async def send(self, channel_id, content):
+        """Sends a message to a channel, returns whether it was delivered."""
+        channel = self.bot.get_channel(int(channel_id))
+        if channel is None:
+            self.failed += 1
+            log.warning(f'Cannot send to channel {channel_id}: channel not found')
+            return False
+
+        # Wait for the rate limits before taking a slot, so that a busy channel doesn't hold one
+        await self._bucket(self.guild_buckets, channel.guild.id, self.guild_rate).acquire()
+        await self._bucket(self.channel_buckets, channel_id, self.channel_rate).acquire()
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    await channel.send(content)
+            except (discord.Forbidden, discord.NotFound) as e:
+                self.failed += 1
+                log.warning(f'Cannot send to channel {channel_id}: {e}')
+                return False
+            except (discord.HTTPException, asyncio.TimeoutError, OSError) as e:
+                if attempt == self.retries:
+                    self.failed += 1
+                    log.warning(f'Giving up sending to channel {channel_id} after {attempt + 1} attempts: {e}')
+                    return False
+                self.retried += 1
+                await asyncio.sleep(2 ** attempt + random.random())
+            else:
+                self.sent += 1
+                return True
+
+    async def send_all(self, channel_ids, content):
+        """Sends a message to several channels at once, returns the ids of those it was delivered to."""
+        channel_ids = list(channel_ids)
+        results = await asyncio.gather(*(self.send(channel_id, content) for channel_id in channel_ids))
+        return [channel_id for channel_id, delivered in zip(channel_ids, results) if delivered]
+
+    def __str__(self):
+        return f'{self.sent} sent, {self.retried} retried, {self.failed} failed'
+
+
+class StreamShard:
+    """Filter stream connection following the share of the followed users assigned to it.
+
+    Each shard connects, reconnects after a failure and catches up on its users independently.
+    """
+
+    def __init__(self, cog, index):
+        self.cog = cog
+        self.index = index
+        self.task = None
+        self.catchup_tasks = set()
+        self.users = set()
+        self.connected_at = None
+        self.connections = 0
+        self.failures = 0
+        self.last_error = None
+        self.tweets = 0
+        self.last_tweet_at = None
+        self.last_catchup = None
+
+    def start(self, catch_up=None):
+        """Starts the stream.
+
+        Once connected, the feeds of the users in `catch_up` are updated, or all of the shard's if None.
+        """
+        if self.task is None and self.cog.shard_users(self.index):
+            self.task = self.cog.bot.loop.create_task(self.run(catch_up))
+
+    def stop(self):
+        """Stops the stream and its catch-ups."""
+        self.catchup_stop()
+        self._disconnect()
+
+    def _disconnect(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.users = set()
+        self.connected_at = None
+
+    def restart(self, catch_up=None):
+        """Restarts the stream, the running catch-ups go on."""
+        self._disconnect()
+        self.start(catch_up)
+
+    def catchup_start(self, user_ids=None):
+        """Starts catching up on the feeds in the background.
+
+        Catching up on all of the shard's users replaces the running catch-ups, while catching up
+        on some of them runs alongside, since the running ones cover other users.
+        """
+        if user_ids is None:
+            self.catchup_stop()
+        task = self.cog.bot.loop.create_task(self.catch_up(user_ids))
+        self.catchup_tasks.add(task)
+        task.add_done_callback(self.catchup_tasks.discard)
+
+    def catchup_stop(self):
+        """Stops catching up on the feeds."""
+        for task in self.catchup_tasks:
+            task.cancel()
+        self.catchup_tasks.clear()
+
+    async def catch_up(self, user_ids=None):
+        """Updates the feeds of the given users, or all of the shard's if None."""
+        self.last_catchup = await self.cog.update_feeds(self.users if user_ids is None else user_ids)
+
+    async def run(self, catch_up=None):
+        """Stream daemon, reconnecting with a backoff when the connection fails."""
+        await self.cog.bot.wait_until_ready()
+
+        while True:
+            self.users = self.cog.shard_users(self.index)
+            try:
+                await self.stream(catch_up)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self.last_error = e
+                self.connected_at = None
+                delay = min(2 ** self.failures, 300)
+                log.warning(f'Stream shard {self.index} failed, reconnecting in {delay} s: {e}')
+                await asyncio.sleep(delay)
+            else:
+                return
+
+            # Tweets of any of the shard's users may have been missed while disconnected
+            catch_up = None
+
+    async def stream(self, catch_up):
+        """Dispatches the tweets of a single stream connection."""
+        async with self.cog.twitter_client.stream.statuses.filter.post(follow=list(self.users)) as stream:
+            async for data in stream:
+                if peony.events.on_tweet(data):
+                    self.tweets += 1
+                    self.last_tweet_at = time.monotonic()
+                    # Keep reading while the tweet is delivered, so that Twitter doesn't see us stall
+                    self.cog.queue.put(data)
+                elif peony.events.on_connect(data):
+                    self.connections += 1
+                    self.failures = 0
+                    self.connected_at = time.monotonic()
+                    # Catch up in the background, live tweets shouldn't wait for it
+                    self.catchup_start(catch_up)
+                    # Later connections are reconnections after a failure, any user may have missed tweets
+                    catch_up = None
+
+    def __str__(self):
+        if self.task is None:
+            return f'shard {self.index}: stopped'
+
+        if self.connected_at is None:
+            state = f'connecting ({self.failures} failures, last error: {self.last_error})' if self.failures else 'connecting'
+        else:
+            uptime = time.monotonic() - self.connected_at
+            state = f'connected for {uptime / 60:.0f} min'
+        last_tweet = 'never' if self.last_tweet_at is None else f'{time.monotonic() - self.last_tweet_at:.0f} s ago'
+        return (f'shard {self.index}: {state}, {len(self.users)} users, {self.connections} connections, '
+                f'{self.tweets} tweets (last {last_tweet}), last catch-up: {self.last_catchup or "none"}')
+
+
+class DeliveryQueue:
+    """Queue of the tweets to deliver, between the stream readers and the delivery workers.
+
+    Accepting a tweet never waits on the deliveries. Every tweet is journaled on disk, and only
+    `max_size` of them are kept in memory, the others are read back from the journal when their
+    turn comes. Tweets still pending when the cog stops are delivered once it starts again.
+
+    Tweets are spread across the workers by author, so that each author's tweets are delivered in order.
+    The journal is compacted once its records of delivered tweets outnumber the pending ones.
+    """
+
+    def __init__(self, file, deliver, workers=4, max_size=1000):
+        self.file = file
+        self.deliver = deliver
+        self.max_size = max_size
+        self.lanes = [collections.deque() for _ in range(workers)]
+        self.ready = [asyncio.Event() for _ in range(workers)]
+        self.seq = 0
+        self.pending = 0
+        self.in_memory = 0
+        self.accepted = 0
+        self.delivered = 0
+        self.spilled = 0
+        self.max_pending = 0
+        self.compactions = 0
+        self.wait = metrics.Histogram()
+        self._journal = None
+        self._done_records = 0
+        self._delivering = {}  # seq -> tweet, taken off the lanes but not delivered yet
+        self._tasks = []
+
+    def start(self, loop):
+        """Starts the workers, after queueing the tweets left pending by the last run."""
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        pending = collections.OrderedDict()
+        if os.path.exists(self.file):
+            with open(self.file, 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn write of the last record
+                    if 'done' in record:
+                        pending.pop(record['done'], None)
+                    else:
+                        pending[record['seq']] = record['tweet']
+
+        # Start a fresh journal with only the pending tweets
+        self._journal = open(self.file + '~', 'wb')
+        for tweet in pending.values():
+            self.put(tweet)
+        self._journal.close()
+        os.replace(self.file + '~', self.file)
+        self._journal = open(self.file, 'ab')
+        if pending:
+            log.info(f'Resuming the delivery of {len(pending)} tweets')
+
+        self._tasks = [loop.create_task(self._work(lane)) for lane in range(len(self.lanes))]
+
+    def put(self, tweet):
+        """Queues a tweet for delivery."""
+        self.seq += 1
+        offset = self._journal.tell()
+        self._journal.write(json.dumps({'seq': self.seq, 'tweet': tweet}).encode() + b'\n')
+        self._journal.flush()
+
+        # Past the limit, only keep where to find the tweet in the journal
+        lane = tweet['user']['id'] % len(self.lanes)
+        if self.in_memory < self.max_size:
+            self.in_memory += 1
+        else:
+            self.spilled += 1
+            tweet = None
+
+        self.lanes[lane].append((self.seq, tweet, offset, time.monotonic()))
+        self.ready[lane].set()
+
+        self.accepted += 1
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+
+    def _read(self, offset):
+        with open(self.file, 'rb') as fp:
+            fp.seek(offset)
+            return json.loads(fp.readline())['tweet']
+
+    async def _work(self, lane):
+        while True:
+            while not self.lanes[lane]:
+                self.ready[lane].clear()
+                await self.ready[lane].wait()
+
+            seq, tweet, offset, queued_at = self.lanes[lane].popleft()
+            if tweet is None:
+                tweet = self._read(offset)
+            else:
+                self.in_memory -= 1
+            self.wait.observe(time.monotonic() - queued_at)
+
+            self._delivering[seq] = tweet
+            try:
+                await self.deliver(tweet)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f'Error delivering tweet {tweet["id"]}')
+            self._done(seq)
+
+    def _done(self, seq):
+        del self._delivering[seq]
+        self.delivered += 1
+        self.pending -= 1
+        if self.pending == 0:
+            # Nothing left to deliver, the journal can start over
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._done_records = 0
+        elif self._done_records >= max(self.max_size, self.pending):
+            self._compact()
+        else:
+            self._journal.write(json.dumps({'done': seq}).encode() + b'\n')
+            self._journal.flush()
+            self._done_records += 1
+
+    def _compact(self):
+        """Rewrites the journal with only the pending tweets, in the order they were accepted."""
+        entries = [(seq, tweet, None, None, None) for seq, tweet in self._delivering.items()]
+        entries.extend((entry[0], entry[1], entry[2], lane, index) for lane in range(len(self.lanes)) for index, entry in enumerate(self.lanes[lane]))
+        entries.sort(key=lambda entry: entry[0])
+
+        with open(self.file, 'rb') as old, open(self.file + '~', 'wb') as fp:
+            for seq, tweet, offset, lane, index in entries:
+                if lane is not None:
+                    # Spilled tweets are read back from their new offset from now on
+                    self.lanes[lane][index] = (seq, tweet, fp.tell(), self.lanes[lane][index][3])
+                if tweet is None:
+                    old.seek(offset)
+                    tweet = json.loads(old.readline())['tweet']
+                fp.write(json.dumps({'seq': seq, 'tweet': tweet}).encode() + b'\n')
+
+        self._journal.close()
+        os.replace(self.file + '~', self.file)
+        self._journal = open(self.file, 'ab')
+        self._done_records = 0
+        self.compactions += 1
+
+    def close(self):
+        """Stops the workers, the pending tweets are kept in the journal."""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def __str__(self):
+        return (f'{self.pending} pending ({self.max_pending} max, {self.spilled} spilled to disk), '
+                f'{self.delivered}/{self.accepted} delivered, {self.compactions} journal compactions, '
+                f'wait {self.wait.summary(1000, " ms")}')
+
+
+class UserCache:
+    """Cache of Twitter users, by id and by lowercase screen name.
+
+    Users are kept for `ttl` seconds, the least recently used ones are evicted past `max_size`.
+    Search results are cached the same way, as lists of user ids.
+    """
+
+    def __init__(self, ttl=900, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.users = collections.OrderedDict()  # user_id -> (expires_at, user)
+        self.user_ids = {}  # screen_name -> user_id
+        self.searches = collections.OrderedDict()  # (query, limit) -> (expires_at, [user_id])
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, user):
+        """Caches a user."""
+        user_id = user['id']
+        cached = self.users.pop(user_id, None)
+        if cached is not None and 'status' in cached[1] and 'status' not in user:
+            # Users embedded in tweets come without their latest status, keep the known one
+            user = dict(user, status=cached[1]['status'])
+
+        self.users[user_id] = (time.monotonic() + self.ttl, user)
+        self.user_ids[user['screen_name'].lower()] = user_id
+        while len(self.users) > self.max_size:
+            _, (_, evicted) = self.users.popitem(last=False)
+            self.user_ids.pop(evicted['screen_name'].lower(), None)
+
+    def put_tweet(self, tweet):
+        """Caches the author of a tweet, along with the tweet as their latest status."""
+        user = tweet['user']
+        cached = self.users.get(user['id'])
+        if cached is None or cached[1].get('status', {}).get('id', 0) < tweet['id']:
+            user = dict(user, status={'id': tweet['id']})
+        self.put(user)
+
+        # Retweets embed the original tweet, with its author
+        if 'retweeted_status' in tweet:
+            self.put(tweet['retweeted_status']['user'])
+
+    def get(self, user_id=None, screen_name=None):
+        """Returns a cached user, or None."""
+        if user_id is None:
+            user_id = self.user_ids.get(screen_name.lower())
+
+        cached = self.users.get(user_id)
+        if cached is None or cached[0] < time.monotonic():
+            self.misses += 1
+            return None
+
+        self.users.move_to_end(user_id)
+        self.hits += 1
+        return cached[1]
+
+    def put_search(self, query, limit, users):
+        """Caches the result of a search, along with the users found."""
+        for user in users:
+            self.put(user)
+        self.searches[(query.lower(), limit)] = (time.monotonic() + self.ttl, [user['id'] for user in users])
+        while len(self.searches) > self.max_size:
+            self.searches.popitem(last=False)
+
+    def get_search(self, query, limit):
+        """Returns the cached result of a search, or None."""
+        key = (query.lower(), limit)
+        cached = self.searches.get(key)
+        users = None
+        if cached is not None and cached[0] >= time.monotonic():
+            users = [self.users.get(user_id) for user_id in cached[1]]
+        # Any user of the result may have been evicted since
+        if users is None or None in users:
+            self.misses += 1
+            return None
+
+        self.searches.move_to_end(key)
+        self.hits += 1
+        return [user for _, user in users]
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'{len(self.users)} users cached, {self.hits}/{lookups} hits ({hit_rate:.0%})'
+
+
+class DeliveryLedger:
+    """Remembers the latest tweets delivered to each feed, so that none is delivered twice.
+
+    A feed is a followed user in a channel. Only the latest `window` tweets of each feed are
+    remembered, older duplicates are caught by the feed's checkpoint instead.
+    """
+
+    def __init__(self, window=50):
+        self.window = window
+        self.feeds = {}
+        self.suppressed = 0
+
+    def claim(self, user_id, channel_id, tweet_id):
+        """Records a tweet as delivered to a feed, returns False if it already was."""
+        seen = self.feeds.setdefault((user_id, channel_id), collections.OrderedDict())
+        if tweet_id in seen:
+            self.suppressed += 1
+            return False
+
+        seen[tweet_id] = None
+        if len(seen) > self.window:
+            seen.popitem(last=False)
+        return True
+
+    def release(self, user_id, channel_id, tweet_id):
+        """Forgets a tweet that could not be delivered after all."""
+        self.feeds.get((user_id, channel_id), {}).pop(tweet_id, None)
+
+    def forget(self, user_id, channel_id):
+        """Forgets a feed."""
+        self.feeds.pop((user_id, channel_id), None)
+
+    def __str__(self):
+        return f'{self.suppressed} duplicates suppressed, {len(self.feeds)} feeds tracked'
+
+
+class FollowIndex:
+    """Indexes over the followed users, by screen name, by channel and by guild.
+
+    The follows must only be changed through `add` and `remove`, which update them along with
+    the indexes so that they never disagree.
+    """
+
+    def __init__(self, bot, follows):
+        self.bot = bot
+        self.follows = follows
+        self.user_ids = {}  # screen_name -> user_id
+        self.channels = {}  # channel_id -> {user_id}
+        self.guilds = {}  # guild_id -> {channel_id}
+        self.channel_guilds = {}  # channel_id -> guild_id
+        for user_id, conf in follows.items():
+            self.user_ids[conf.screen_name] = user_id
+            for channel_id in conf.channels:
+                self.channels.setdefault(channel_id, set()).add(user_id)
+        self.index_guilds()
+
+    def index_guilds(self):
+        """Indexes the channels by guild, for those whose guild is known."""
+        for channel_id in self.channels.keys() - self.channel_guilds.keys():
+            channel = self.bot.get_channel(channel_id)
+            if channel is not None:
+                self._index_guild(channel_id, channel.guild.id)
+
+    def _index_guild(self, channel_id, guild_id):
+        self.channel_guilds[channel_id] = guild_id
+        self.guilds.setdefault(guild_id, set()).add(channel_id)
+
+    def get(self, screen_name):
+        """Returns the id and config of a followed user, or None, None if not followed."""
+        user_id = self.user_ids.get(screen_name)
+        return user_id, self.follows.get(user_id)
+
+    def add(self, user_id, screen_name, channel_id, guild_id, last_tweet_id):
+        """Follows a user in a channel, returns the user's config."""
+        conf = self.follows.get(user_id)
+        if conf is None:
+            conf = Follow(screen_name=screen_name, channels=config.RecordDict())
+            self.follows[user_id] = conf
+            self.user_ids[screen_name] = user_id
+
+        conf.channels[channel_id] = Checkpoint(last_tweet_id=last_tweet_id)
+        self.channels.setdefault(channel_id, set()).add(user_id)
+        self._index_guild(channel_id, guild_id)
+        return conf
+
+    def remove(self, user_id, channel_id):
+        """Unfollows a user in a channel, returns whether the user isn't followed anymore."""
+        conf = self.follows[user_id]
+        del conf.channels[channel_id]
+
+        users = self.channels[channel_id]
+        users.discard(user_id)
+        if not users:
+            del self.channels[channel_id]
+            guild_id = self.channel_guilds.pop(channel_id, None)
+            if guild_id is not None:
+                channels = self.guilds[guild_id]
+                channels.discard(channel_id)
+                if not channels:
+                    del self.guilds[guild_id]
+
+        if len(conf.channels) == 0:
+            del self.follows[user_id]
+            del self.user_ids[conf.screen_name]
+            return True
+        return False
+
+    def remove_channel(self, channel_id):
+        """Unfollows every user in a channel, returns how many feeds were removed and users unfollowed."""
+        user_ids = self.channels.get(channel_id, set()).copy()
+        unfollowed = sum(self.remove(user_id, channel_id) for user_id in user_ids)
+        return len(user_ids), unfollowed
+
+
 class Twitter(commands.Cog):
     """🕊️🐦🐼"""
 
     def __init__(self, bot):
         self.bot = bot
-        self.conf = config.Config('conf/twitter.json', encoding='utf-8')
-        self.twitter_client = peony.PeonyClient(**self.conf.credentials)
-        self.stream_task = None
-        self.stream_start()
+        self.stream_update_task = None
+
+        # Keep streaming and delivering through a reload
+        if handoff.claim(bot, self, HANDOFF_VERSION, self.adopt_state):
+            # Follow the changes made while the previous instance was waiting to reconnect, if any
+            self.stream_update()
+            return
+
+        self.conf = config.Config(config.locate('conf/twitter'), encoding='utf-8', schema=CONF_SCHEMA)
+        self.conf_saver = config.WriteBehind(self.conf, self.conf.save_interval or 5, self.conf.save_batch or 100)
+        self.conf_saver.start(self.bot.loop)
+        self.fanout = FanOut(self.bot, self.conf.fanout_concurrency or 20)
+        # The user timeline endpoint allows 900 requests per 15 minutes window
+        self.timeline_bucket = TokenBucket(self.conf.timeline_rate or 900, 900)
+        self.catchup_semaphore = asyncio.Semaphore(self.conf.catchup_concurrency or 10)
+        self._twitter_client = None
+        self.queue = DeliveryQueue(self.conf.queue_file or 'cache/twitter/queue.jsonl', self.dispatch_tweet,
+                                   self.conf.delivery_workers or 4, self.conf.delivery_queue_size or 1000)
+        self.queue.start(self.bot.loop)
+        self.users = UserCache(self.conf.user_cache_ttl or 900, self.conf.user_cache_size or 10000)
+        self.index = FollowIndex(self.bot, self.conf.follows)
+        self.ledger = DeliveryLedger(self.conf.dedup_window or 50)
+
+        # The number of shards only changes across loads, so that users always stay on the same one
+        # A stream connection can follow up to 5000 users, keep some headroom for the shards to grow
+        shards = self.conf.stream_shards or max(1, math.ceil(len(self.conf.follows) * 2 / 5000))
+        self.shards = [StreamShard(self, index) for index in range(shards)]
+        # Otherwise the streams start once the bot is ready
+        if self.bot.is_ready():
+            self.stream_start()
+
+    @property
+    def twitter_client(self):
+        """The Twitter client, created on first use."""
+        if self._twitter_client is None:
+            self._twitter_client = peony.PeonyClient(**self.conf.credentials)
+        return self._twitter_client
 
     def cog_unload(self):
         """Handles special unloading."""
+        if self.stream_update_task is not None:
+            self.stream_update_task.cancel()
+
+        state = {
+            'conf': self.conf,
+            'conf_saver': self.conf_saver,
+            'fanout': self.fanout,
+            'timeline_bucket': self.timeline_bucket,
+            'catchup_semaphore': self.catchup_semaphore,
+            'twitter_client': self._twitter_client,
+            'queue': self.queue,
+            'users': self.users,
+            'index': self.index,
+            'ledger': self.ledger,
+            'shards': self.shards,
+        }
+        if not handoff.offer(self.bot, self, HANDOFF_VERSION, state, self.teardown):
+            self.teardown()
+
+    def teardown(self):
+        """Stops the streams and the deliveries, and saves the config."""
         self.stream_stop()
+        self.queue.close()
+        self.conf_saver.close()
+        self.conf.close()
+        log.info(f'Twitter config persistence: {self.conf_saver}')
+
+    def adopt_state(self, state):
+        """Takes over the config, streams and delivery queue of the previous instance of the cog.
+
+        The objects are made instances of the reloaded classes, and the streams and delivery
+        workers already running call into this instance from then on.
+        """
+        self.conf = state['conf']
+        self.conf_saver = state['conf_saver']
+        self.fanout = handoff.adopt(state['fanout'], FanOut)
+        for bucket in (*self.fanout.channel_buckets.values(), *self.fanout.guild_buckets.values()):
+            handoff.adopt(bucket, TokenBucket)
+        self.timeline_bucket = handoff.adopt(state['timeline_bucket'], TokenBucket)
+        self.catchup_semaphore = state['catchup_semaphore']
+        self._twitter_client = state['twitter_client']
+        self.users = handoff.adopt(state['users'], UserCache)
+        self.index = handoff.adopt(state['index'], FollowIndex)
+        self.ledger = handoff.adopt(state['ledger'], DeliveryLedger)
+
+        self.queue = handoff.adopt(state['queue'], DeliveryQueue)
+        self.queue.deliver = self.dispatch_tweet
+        self.shards = [handoff.adopt(shard, StreamShard) for shard in state['shards']]
+        for shard in self.shards:
+            shard.cog = self
 
     def cog_check(self, ctx):
         """Extra checks for the cog's commands."""
@@ -57,49 +734,77 @@ class Twitter(commands.Cog):
         finally:
             await ctx.message.add_reaction('\N{CROSS MARK}')
 
-    def remove_channels_from_conf(self, *channels):
-        """Remove the given channel from the conf."""
+    def remove_channels_from_conf(self, *channel_ids):
+        """Remove the given channels from the conf."""
         removed = 0
         unfollowed = 0
-        channels = set(channels)
-        for user_id, conf in self.conf.follows.copy().items():
-            for c in channels & set(conf.channels):
-                conf.channels.pop(c)
-                removed += 1
-
-            if len(conf.channels) == 0:
-                del self.conf.follows[user_id]
-                unfollowed += 1
-        self.conf.save()
+        for channel_id in channel_ids:
+            for user_id in self.index.channels.get(channel_id, ()):
+                self.ledger.forget(user_id, channel_id)
+            channel_removed, channel_unfollowed = self.index.remove_channel(channel_id)
+            removed += channel_removed
+            unfollowed += channel_unfollowed
 
+        if removed > 0:
+            self.conf.save()
         if unfollowed > 0:
-            self.stream_restart()
+            self.stream_update()
         return removed, unfollowed
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """Called when the bot is ready."""
+        # The guilds of the channels aren't known until then when loading with the bot
+        self.index.index_guilds()
+        self.stream_start()
+
     @commands.Cog.listener()
     async def on_guild_channel_delete(self, channel):
         """Called when a channel is deleted."""
-        removed, unfollowed = self.remove_channels_from_conf(channel)
+        removed, unfollowed = self.remove_channels_from_conf(channel.id)
         log.info(f'Deletion of channel {channel.id} removed {removed} feeds and unfollowed {unfollowed}')
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         """Called when the bot leaves a guild."""
-        removed, unfollowed = self.remove_channels_from_conf(c.id for c in guild.text_channels)
+        removed, unfollowed = self.remove_channels_from_conf(*self.index.guilds.get(guild.id, ()))
         log.info(f'Removal of guild {guild.id} removed {removed} feeds and unfollowed {unfollowed}')
 
-    async def dispatch_tweet(self, tweet):
-        """Dispatch a tweet into Discord."""
-        tweet_url = build_tweet_url(tweet['user']['screen_name'], tweet['id'])
+    async def dispatch_tweet(self, tweet, checkpoints=None):
+        """Dispatch a tweet into Discord.
+
+        The tweet is only sent to the channels it wasn't delivered to yet, and whose checkpoint
+        doesn't cover it. The checkpoints can be given to use ones from before the dispatch of
+        newer tweets, channels followed since then use their current one.
+        """
+        self.users.put_tweet(tweet)
+        tweet_id = tweet['id']
+        user_id = tweet['user']['id']
+        tweet_url = build_tweet_url(tweet['user']['screen_name'], tweet_id)
         try:
-            conf = self.conf.follows[tweet['user']['id']]
+            conf = self.conf.follows[user_id]
         except KeyError:
             return  # Apparently peony dispatch retweets of any users we're following as well
 
-        for channel_id in conf.channels:
-            await self.bot.get_channel(int(channel_id)).send(tweet_url)
-            conf.channels[channel_id].last_tweet_id = tweet['id']
-            self.conf.save()
+        channel_ids = []
+        for channel_id, channel_conf in conf.channels.items():
+            checkpoint = channel_conf.last_tweet_id if checkpoints is None else checkpoints.get(channel_id, channel_conf.last_tweet_id)
+            if tweet_id <= checkpoint:
+                self.ledger.suppressed += 1
+            elif self.ledger.claim(user_id, channel_id, tweet_id):
+                channel_ids.append(channel_id)
+        if not channel_ids:
+            return
+
+        delivered = await self.fanout.send_all(channel_ids, tweet_url)
+        for channel_id in set(channel_ids).difference(delivered):
+            self.ledger.release(user_id, channel_id, tweet_id)
+
+        for channel_id in delivered:
+            # The channel may have been unfollowed while sending, and catch-up may deliver older tweets
+            if channel_id in conf.channels and tweet['id'] > conf.channels[channel_id].last_tweet_id:
+                conf.channels[channel_id].last_tweet_id = tweet['id']
+                self.conf_saver.mark_dirty()
 
     async def get_timeline(self, user_id=None, screen_name=None, limit: int = 3):
         """Returns a list of tweet from the given user's timeline."""
@@ -126,53 +831,126 @@ class Twitter(commands.Cog):
         tweets = []
         async for chunk in responses:
             tweets.extend(chunk)
+        for tweet in tweets:
+            self.users.put_tweet(tweet)
         return tweets
 
-    async def get_timelines(self):
-        """Get the timeline from all the followed users."""
-        for user_id, conf in self.conf.follows.items():
-            yield await self.get_timeline(user_id=user_id)
+    async def get_stale_users(self, user_ids):
+        """Returns the followed users who tweeted since their checkpoint."""
+        stale = []
+        for i in range(0, len(user_ids), 100):
+            chunk = user_ids[i:i + 100]
+            try:
+                resp = await self.twitter_client.api.users.lookup.post(user_id=','.join(str(user_id) for user_id in chunk), include_entities=False)
+            except peony.exceptions.PeonyException as e:
+                log.warning(f'Could not look up followed users, catching up on all of them: {e}')
+                stale.extend(chunk)
+                continue
+
+            users = {user['id']: user for user in resp.data}
+            for user in resp.data:
+                self.users.put(user)
+            for user_id in chunk:
+                conf = self.conf.follows.get(user_id)
+                user = users.get(user_id)
+                if conf is None or user is None or 'status' not in user:
+                    continue
+                if user['status']['id'] > min(c.last_tweet_id for c in conf.channels.values()):
+                    stale.append(user_id)
+        return stale
+
+    async def catch_up(self, user_id):
+        """Dispatches the tweets a followed user posted since their checkpoint, returns how many."""
+        async with self.catchup_semaphore:
+            if user_id not in self.conf.follows:
+                return 0
+            await self.timeline_bucket.acquire()
+            # Live tweets may move the checkpoints while dispatching, the timeline must be compared against these
+            conf = self.conf.follows.get(user_id)
+            if conf is None:
+                return 0
+            checkpoints = {channel_id: c.last_tweet_id for channel_id, c in conf.channels.items()}
+            try:
+                timeline = await self.get_timeline(user_id=user_id)
+            except peony.exceptions.PeonyException as e:
+                log.warning(f'Could not catch up on user {user_id}: {e}')
+                return 0
+
+        # Dispatch without holding a slot, to keep fetching the other timelines meanwhile
+        for timeline_tweet in reversed(timeline):
+            await self.dispatch_tweet(timeline_tweet, checkpoints)
+        return len(timeline)
+
+    async def update_feeds(self, user_ids=None):
+        """Update the feeds with their missing tweets, if any, and returns a summary.
+
+        Only the given users are updated if any, all the followed users otherwise.
+        """
+        started_at = time.perf_counter()
+        if user_ids is None:
+            user_ids = list(self.conf.follows)
+        else:
+            user_ids = [user_id for user_id in user_ids if user_id in self.conf.follows]
+        stale = await self.get_stale_users(user_ids)
+
+        recovered = sum(await asyncio.gather(*(self.catch_up(user_id) for user_id in stale)))
 
-    async def update_feeds(self):
-        """Update the feeds with their missing twets, if any."""
-        async for timeline in self.get_timelines():
-            for timeline_tweet in reversed(timeline):
-                await self.dispatch_tweet(timeline_tweet)
+        duration = time.perf_counter() - started_at
+        summary = f'{recovered} tweets recovered from {len(stale)}/{len(user_ids)} users in {duration:.1f} s'
+        log.info(f'Catch-up done: {summary}')
+        return summary
+
+    def shard_users(self, index):
+        """Returns the followed users assigned to a stream shard."""
+        return {user_id for user_id in self.conf.follows if user_id % len(self.shards) == index}
 
     def stream_start(self):
-        """Starts the Twitter stream."""
-        if len(self.conf.follows) > 0 and self.stream_task is None:
-            self.stream_task = self.bot.loop.create_task(self.stream_tweets())
+        """Starts the Twitter streams."""
+        for shard in self.shards:
+            shard.start()
 
     def stream_stop(self):
-        """Stops the Twitter stream."""
-        if self.stream_task is not None:
-            self.stream_task.cancel()
-            self.stream_task = None
+        """Stops the Twitter streams."""
+        for shard in self.shards:
+            shard.stop()
 
-    def stream_restart(self):
-        """Restarts the Twitter stream."""
-        self.stream_stop()
-        self.stream_start()
+    def stream_update(self):
+        """Schedules the streams to follow the changes made to the followed users.
 
-    async def stream_tweets(self):
-        """Twitter stream daemon."""
-        await self.bot.wait_until_ready()
-        
-        async with self.twitter_client.stream.statuses.filter.post(follow=list(self.conf.follows.keys())) as stream:
-            async for data in stream:
-                if peony.events.on_tweet(data):
-                    await self.dispatch_tweet(data)
-                elif peony.events.on_connect(data):
-                    await self.update_feeds()
+        Changes are batched over a short delay, so that bursts of follows only reconnect once.
+        """
+        if self.stream_update_task is None:
+            self.stream_update_task = self.bot.loop.create_task(self.stream_reconfigure())
+
+    async def stream_reconfigure(self):
+        """Reconnects the shards whose users were followed since they connected."""
+        await asyncio.sleep(self.conf.stream_debounce or 5)
+        self.stream_update_task = None
+
+        for shard in self.shards:
+            users = self.shard_users(shard.index)
+            added = users - shard.users
+            if not users:
+                shard.stop()
+            elif shard.task is None:
+                shard.start(added)
+            elif added:
+                log.info(f'Reconnecting stream shard {shard.index} to follow {len(added)} new users')
+                shard.restart(added)
+            # Unfollowed users stay in their shard until its next reconnection, dispatch_tweet ignores them
+
+            if len(users) > 5000:
+                log.warning(f'Stream shard {shard.index} follows {len(users)} users, above the limit of 5000, '
+                            f'raise stream_shards in the config')
 
     @commands.command()
     async def list(self, ctx):
         """Lists the followed channels on the server."""
         follows = {}
-        for conf in self.conf.follows.values():
-            for channel_id in set(conf.channels) & set(c.id for c in ctx.guild.text_channels):
-                follows.setdefault(discord.utils.get(ctx.guild.text_channels, id=channel_id), []).append(f'@\N{ZERO WIDTH SPACE}{conf.screen_name}')
+        for channel_id in self.index.guilds.get(ctx.guild.id, ()):
+            channel = ctx.guild.get_channel(channel_id)
+            if channel is not None:
+                follows[channel] = [f'@\N{ZERO WIDTH SPACE}{self.conf.follows[user_id].screen_name}' for user_id in self.index.channels[channel_id]]
 
         if len(follows) == 0:
             raise TwitterError('Not following any channel on this server.')
@@ -183,18 +961,31 @@ class Twitter(commands.Cog):
 
         await ctx.send(embed=embed)
 
+    @commands.command()
+    @commands.is_owner()
+    async def twitterstats(self, ctx):
+        """Shows the state of the Twitter cog.
+
+        Only the bot owner can use this command.
+        """
+        shards = '\n'.join(str(shard) for shard in self.shards)
+        await ctx.send(f'Config persistence: {self.conf_saver}\nDeliveries: {self.fanout}, {self.ledger}\nQueue: {self.queue}\nUsers: {self.users}\nStreams:\n{shards}')
+
     @commands.command()
     async def search(self, ctx, query, limit: int = 5):
         """Searches for a Twitter user.
 
         To use a multi-word query, enclose it in quotes.
         """
-        try:
-            resp = await self.twitter_client.api.users.search.get(q=query, count=limit)
-        except peony.exceptions.NotFound:
-            raise TwitterError(f'No result when searching for {query}')
+        users = self.users.get_search(query, limit)
+        if users is None:
+            try:
+                resp = await self.twitter_client.api.users.search.get(q=query, count=limit)
+            except peony.exceptions.NotFound:
+                raise TwitterError(f'No result when searching for {query}')
+            users = resp.data
+            self.users.put_search(query, limit, users)
 
-        users = resp.data
         if len(users) == 0:
             raise TwitterError('No result.')
 
@@ -222,35 +1013,37 @@ class Twitter(commands.Cog):
         sent to the channel this command was used in.
         """
         screen_name = handle.lower().lstrip('@')
-        user_id, conf = config.get(self.conf.follows, screen_name=screen_name)
+        user_id, conf = self.index.get(screen_name)
 
         if conf is not None and ctx.channel.id in conf.channels:
             raise TwitterError(f'Already following {screen_name} in this channel.')
 
         if conf is None:
-            try:
-                resp = await self.twitter_client.api.users.show.get(screen_name=screen_name)
-            except peony.exceptions.NotFound:
-                raise TwitterError(f'User {screen_name} not found.')
-            user = resp.data
+            user = self.users.get(screen_name=screen_name)
+            # The latest status is needed to start following, users who never tweeted don't have one
+            if user is None or 'status' not in user:
+                try:
+                    resp = await self.twitter_client.api.users.show.get(screen_name=screen_name)
+                except peony.exceptions.NotFound:
+                    raise TwitterError(f'User {screen_name} not found.')
+                user = resp.data
+                self.users.put(user)
 
             # Retrieving tweets from protected users is only allowed by that user or approved followers
             if user['protected']:
                 raise TwitterError('This user is protected and cannot be followed.')
 
-            conf = config.ConfigElement(screen_name=screen_name, channels={})
-            self.conf.follows[user['id']] = conf
-
+            user_id = user['id']
             tweet_url = build_tweet_url(screen_name, user["status"]["id"])
             last_tweet_id = user['status']['id']
         else:
             last_tweet_id = max(c.last_tweet_id for c in conf.channels.values())
             tweet_url = build_tweet_url(screen_name, last_tweet_id)
 
-        conf.channels[ctx.channel.id] = config.ConfigElement(last_tweet_id=last_tweet_id)
+        self.index.add(user_id, screen_name, ctx.channel.id, ctx.guild.id, last_tweet_id)
         self.conf.save()
 
-        self.stream_restart()
+        self.stream_update()
         await ctx.send(tweet_url)
         await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
 
@@ -263,18 +1056,13 @@ class Twitter(commands.Cog):
         sent to the channel this command was used in anymore.
         """
         screen_name = handle.lower().lstrip('@')
-        user_id, conf = config.get(self.conf.follows, screen_name=screen_name)
-        if conf is None:
+        user_id, conf = self.index.get(screen_name)
+        if conf is None or ctx.channel.id not in conf.channels:
             raise TwitterError(f'Not following {screen_name} on this channel.')
 
-        try:
-            del conf.channels[ctx.channel.id]
-        except KeyError:
-            raise TwitterError(f'Not following {screen_name} on this channel.')
-
-        if len(conf.channels) == 0:
-            del self.conf.follows[user_id]
-            self.stream_restart()
+        self.ledger.forget(user_id, ctx.channel.id)
+        if self.index.remove(user_id, ctx.channel.id):
+            self.stream_update()
         self.conf.save()
 
         await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
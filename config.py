@@ -1,8 +1,16 @@
+import asyncio
 import collections
+import collections.abc
 import inspect
 import json
+import logging
 import operator
 import os
+import sqlite3
+import sys
+import threading
+
+log = logging.getLogger(__name__)
 
 
 def get(iterable, **attrs):
@@ -19,31 +27,251 @@ def get(iterable, **attrs):
     return None
 
 
+def locate(name):
+    """Returns the file of the config with the given name, preferring a migrated database over json."""
+    return f'{name}.db' if os.path.exists(f'{name}.db') else f'{name}.json'
+
+
+def open_storage(file, encoding=None):
+    """Returns the storage engine for a config file, chosen from its extension."""
+    if os.path.splitext(file)[1] in ('.db', '.sqlite', '.sqlite3'):
+        return SQLiteStorage(file)
+    return JSONStorage(file, encoding)
+
+
+class JSONStorage:
+    """Stores a config in a json file, rewritten in full on every save."""
+
+    def __init__(self, file, encoding=None):
+        self.file = file
+        self.encoding = encoding
+
+    def load(self, hooks):
+        """Returns the config's data, decoded with the given json hooks."""
+        with open(self.file, 'r', encoding=self.encoding) as fp:
+            return json.load(fp, **hooks)
+
+    def dumps(self, data, encoder):
+        """Serializes the config's data."""
+        data = _top_level(data)
+        if not isinstance(data, dict):
+            return _encode(data, encoder)
+        return '{' + ', '.join(f'{json.dumps(str(k))}: {_encode(v, encoder)}' for k, v in data.items()) + '}'
+
+    def write(self, data):
+        """Writes serialized data, returns the number of bytes written.
+
+        The file is replaced only once the new data is safely on disk, so it is never
+        left half written.
+        """
+        tmp_file = self.file + '~'
+        with open(tmp_file, 'w', encoding=self.encoding) as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file, self.file)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage:
+    """Stores a config in an SQLite database.
+
+    Every entry of the config's top level mappings is stored in its own row, along with the
+    other top level values. Saves only write the rows that changed, in a single transaction.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self._rows = {}
+        self._connection = sqlite3.connect(file, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def load(self, hooks):
+        """Returns the config's data, decoded with the given json hooks."""
+        self._rows = dict(self._connection.execute('SELECT key, value FROM entries ORDER BY rowid'))
+
+        root = []
+        mappings = {}
+        for key, value in self._rows.items():
+            name, sep, entry = key.partition('/')
+            if not sep:
+                root.append((name, json.loads(value, **hooks)))
+                continue
+
+            if name not in mappings:
+                mappings[name] = []
+                root.append((name, mappings[name]))
+            # Mappings have a marker row without entry, so that they are kept even when empty
+            if entry:
+                mappings[name].append((entry, json.loads(value, **hooks)))
+
+        return _make_object(hooks, [(name, _make_object(hooks, value) if name in mappings else value) for name, value in root])
+
+    def dumps(self, data, encoder):
+        """Serializes the config's data into rows."""
+        return dict(_split_rows(_top_level(data), lambda value: _encode(value, encoder)))
+
+    def write(self, rows):
+        """Writes the rows that changed since the last write, returns the number of bytes written."""
+        changed = [(key, value) for key, value in rows.items() if self._rows.get(key) != value]
+        removed = [(key,) for key in self._rows.keys() - rows.keys()]
+        with self._connection:
+            self._connection.executemany('INSERT INTO entries (key, value) VALUES (?, ?) '
+                                         'ON CONFLICT (key) DO UPDATE SET value = excluded.value', changed)
+            self._connection.executemany('DELETE FROM entries WHERE key = ?', removed)
+        self._rows = rows
+        return sum(len(key) + len(value) for key, value in changed)
+
+    def close(self):
+        self._connection.close()
+
+
+def _make_object(hooks, pairs):
+    """Builds a json object from its pairs, the way json would with the given hooks."""
+    if 'object_pairs_hook' in hooks:
+        return hooks['object_pairs_hook'](pairs)
+    if 'object_hook' in hooks:
+        return hooks['object_hook'](dict(pairs))
+    return dict(pairs)
+
+
+def _split_rows(data, dumps):
+    """Yields the rows of the top level values of a config, and of the entries of its mappings."""
+    for name, value in data.items():
+        # ConfigElements are records rather than mappings of entries, keep them whole
+        if isinstance(value, dict) and '__class__' not in value:
+            yield f'{name}/', '{}'
+            for key, entry in value.items():
+                yield f'{name}/{key}', dumps(entry)
+        else:
+            yield name, dumps(value)
+
+
+def migrate(file, target=None):
+    """Copies a json config into an SQLite database, next to it by default."""
+    target = target or os.path.splitext(file)[0] + '.db'
+    if os.path.exists(target):
+        raise FileExistsError(f'{target} already exists.')
+
+    def object_hook(pairs):
+        # Serialize the class last like _ConfigEncoder, so that the first save doesn't rewrite every row
+        o = collections.OrderedDict(pairs)
+        if '__class__' in o:
+            o.move_to_end('__class__')
+        return o
+
+    with open(file, 'r', encoding='utf-8') as fp:
+        data = json.load(fp, object_pairs_hook=object_hook)
+
+    storage = SQLiteStorage(target)
+    try:
+        storage.write(dict(_split_rows(data, lambda value: json.dumps(value, ensure_ascii=True))))
+    finally:
+        storage.close()
+    return target
+
+
+class Schema:
+    """Describes the content of a config, to decode it in a single pass.
+
+    The ConfigElement subclasses it contains must be given in `classes`, and `int_keys` names
+    the attributes holding mappings whose keys are integers. `records` maps the attributes
+    holding mappings of records to the Record subclass of their values, entries stored as
+    ConfigElements are converted.
+    """
+
+    def __init__(self, classes=(), int_keys=(), records=None):
+        records = dict(records or {})
+        self.classes = {cls.__qualname__: cls for cls in (ConfigElement, *classes, *records.values())}
+        self.mappings = {key: (key in int_keys, records.get(key)) for key in {*int_keys, *records}}
+
+    def decode(self, o):
+        """Decodes a json object."""
+        for key, (int_keys, cls) in self.mappings.items():
+            if key not in o:
+                continue
+            if cls is None:
+                o[key] = {int(k): v for k, v in o[key].items()}
+            else:
+                o[key] = RecordDict((int(k) if int_keys else k, v if type(v) is cls else cls(**v)) for k, v in o[key].items())
+
+        name = o.pop('__class__', None)
+        if name is None:
+            return o
+        try:
+            cls = self.classes[name]
+        except KeyError:
+            raise KeyError(f'Class {name} is not part of the schema.')
+        return cls(**o)
+
+
 class Config:
-    """The config object, created from a json file."""
+    """The config object, created from a json file or an SQLite database.
+
+    Without a schema, keys are converted to integers wherever possible and classes are looked
+    up in the caller's module, which is much slower.
+    """
 
     def __init__(self, file, **options):
         super().__setattr__('_data', {})
         self.file = file
         self.encoding = options.pop('encoding', None)
-        self.object_hook = options.pop('object_hook', _ConfigDecoder().decode)
+        self.schema = options.pop('schema', None)
+        if self.schema is not None:
+            self.hooks = {'object_hook': self.schema.decode}
+        else:
+            self.hooks = {'object_pairs_hook': options.pop('object_hook', _ConfigDecoder().decode)}
         self.encoder = options.pop('encoder', _ConfigEncoder)
+        self.storage = options.pop('storage', None) or open_storage(file, self.encoding)
+        self.saves = 0
+        self.bytes_written = 0
+        self._write_lock = threading.Lock()
+        self._version = 0
+        self._written_version = 0
 
-        with open(self.file, 'r', encoding=self.encoding) as fp:
-            self._data = json.load(fp, object_pairs_hook=self.object_hook)
+        self._data = self.storage.load(self.hooks)
 
     def save(self):
         """Saves the config on disk."""
-        tmp_file = self.file + '~'
-        with open(tmp_file, 'w', encoding=self.encoding) as fp:
-            json.dump(self._data, fp, ensure_ascii=True, cls=self.encoder)
-        os.replace(tmp_file, self.file)
+        self.write(self.dumps())
+
+    def dumps(self):
+        """Serializes the config, returns a snapshot to give to `write`."""
+        self._version += 1
+        return self._version, self.storage.dumps(self._data, self.encoder)
+
+    def write(self, snapshot):
+        """Writes a snapshot of the config on disk.
+
+        Snapshots older than the last one written are ignored, so concurrent writers never
+        overwrite newer data. Safe to call from another thread.
+        """
+        version, data = snapshot
+        with self._write_lock:
+            if version <= self._written_version:
+                return
+            self.bytes_written += self.storage.write(data)
+            self._written_version = version
+            self.saves += 1
+
+    def close(self):
+        """Releases the storage."""
+        with self._write_lock:
+            self.storage.close()
 
     # utility
 
     def __contains__(self, item):
         return item in self._data
 
+    def __getitem__(self, item):
+        return self._data[item]
+
     def __len__(self):
         return len(self._data)
 
@@ -57,12 +285,80 @@ class Config:
             super().__setattr__(key, value)
 
 
-class ConfigElement(collections.Mapping):
+class WriteBehind:
+    """Saves a config in the background, coalescing the changes made in between saves.
+
+    Changes marked with `mark_dirty` are saved at most `interval` seconds later, or as soon
+    as `batch` of them are pending. `close` saves whatever is left.
+    """
+
+    def __init__(self, conf, interval=5, batch=100):
+        self.conf = conf
+        self.interval = interval
+        self.batch = batch
+        self.pending = 0
+        self.changes = 0
+        self.flushes = 0
+        self.failures = 0
+        self._flush_now = asyncio.Event()
+        self._task = None
+
+    def start(self, loop):
+        """Starts saving in the background."""
+        self._task = loop.create_task(self._run())
+
+    def mark_dirty(self):
+        """Marks the config as changed."""
+        self.pending += 1
+        self.changes += 1
+        if self.pending >= self.batch:
+            self._flush_now.set()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+
+            if self.pending > 0:
+                # Serialize on the loop to get a consistent snapshot, write it from a thread
+                flushed = self.pending
+                self.pending = 0
+                self.flushes += 1
+                try:
+                    await loop.run_in_executor(None, self.conf.write, self.conf.dumps())
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Keep the changes pending, the next flush or close saves them
+                    self.pending += flushed
+                    self.failures += 1
+                    log.exception(f'Error saving {self.conf.file}, retrying in {self.interval} s')
+
+    def close(self):
+        """Stops saving in the background and saves the pending changes."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self.pending > 0:
+            self.pending = 0
+            self.flushes += 1
+            self.conf.save()
+
+    def __str__(self):
+        return (f'{self.changes} changes in {self.flushes} flushes ({self.failures} failed), {self.pending} pending, '
+                f'{self.conf.saves} saves totalling {self.conf.bytes_written / 1024:.1f} kB')
+
+
+class ConfigElement(collections.abc.Mapping):
     """The main data holding class."""
 
     def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+        self.__dict__.update(kwargs)
 
     def __getitem__(self, item):
         return self.__dict__[item]
@@ -74,6 +370,141 @@ class ConfigElement(collections.Mapping):
         return iter(self.__dict__)
 
 
+class Record(collections.abc.Mapping):
+    """Base class for declared config entries, which are much more compact than ConfigElements.
+
+    Subclasses declare their fields in `__slots__`. Records that are entries of a top level
+    mapping cache their serialization, which any change to them or to the records and RecordDicts
+    they contain invalidates, so that saving only serializes the entries that changed.
+    """
+
+    __slots__ = ('_json', '_parent')
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = tuple(field for klass in reversed(cls.__mro__) for field in klass.__dict__.get('__slots__', ()) if field[0] != '_')
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, '_json', None)
+        object.__setattr__(self, '_parent', None)
+        # Nothing to invalidate yet
+        for k, v in kwargs.items():
+            object.__setattr__(self, k, v)
+            if isinstance(v, (Record, RecordDict)):
+                object.__setattr__(v, '_parent', self)
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if isinstance(value, (Record, RecordDict)):
+            object.__setattr__(value, '_parent', self)
+        _invalidate(self)
+
+    def __getitem__(self, item):
+        if item not in self._fields:
+            raise KeyError(item)
+        try:
+            return getattr(self, item)
+        except AttributeError:
+            raise KeyError(item)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __iter__(self):
+        return (field for field in self._fields if hasattr(self, field))
+
+
+class RecordDict(dict):
+    """Mapping of records, tracking changes like records do."""
+
+    __slots__ = ('_json', '_parent')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self._json = None
+        self._parent = None
+        self.update(*args, **kwargs)
+
+    def _adopt(self, value):
+        if isinstance(value, (Record, RecordDict)):
+            object.__setattr__(value, '_parent', self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._adopt(value)
+        _invalidate(self)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        _invalidate(self)
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        super().update(items)
+        for value in items.values():
+            self._adopt(value)
+        _invalidate(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        value = super().pop(key, *default)
+        _invalidate(self)
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        _invalidate(self)
+        return item
+
+    def clear(self):
+        super().clear()
+        _invalidate(self)
+
+    def copy(self):
+        return dict(self)
+
+
+def _invalidate(node):
+    """Invalidates the cached serialization of a record or RecordDict, and of those containing it."""
+    while node is not None:
+        object.__setattr__(node, '_json', None)
+        node = node._parent
+
+
+def _encode(value, encoder):
+    """Serializes a value like json.dumps, reusing the cached serializations of records."""
+    if not isinstance(value, (Record, RecordDict)):
+        return json.dumps(value, ensure_ascii=True, cls=encoder)
+    if value._json is not None:
+        return value._json
+
+    if isinstance(value, Record):
+        fields = [f'"{field}": {_encode(getattr(value, field), encoder)}' for field in value]
+        fields.append(f'"__class__": "{type(value).__qualname__}"')
+    else:
+        fields = [f'{json.dumps(str(k))}: {_encode(v, encoder)}' for k, v in value.items()]
+    encoded = '{' + ', '.join(fields) + '}'
+
+    # Only cache the entries of top level mappings, caching the nodes they contain would
+    # duplicate their serialization in memory for no gain
+    parent = value._parent
+    if isinstance(parent, RecordDict) and parent._parent is None:
+        object.__setattr__(value, '_json', encoded)
+    return encoded
+
+
+def _top_level(data):
+    """Returns the top level values of a config."""
+    if isinstance(data, ConfigElement):
+        return {**{k: v for k, v in data.__dict__.items() if k[0] != '_'}, '__class__': type(data).__qualname__}
+    return data
+
+
 class _ConfigEncoder(json.JSONEncoder):
     """Custom JSON encoder."""
 
@@ -88,6 +519,9 @@ class _ConfigEncoder(json.JSONEncoder):
             o.__dict__['__class__'] = o.__class__.__qualname__
             return o.__dict__
 
+        if isinstance(o, Record):
+            return {**o, '__class__': o.__class__.__qualname__}
+
         # Let the base class default method raise the TypeError
         return super().default(self, o)
 
@@ -137,3 +571,10 @@ class _ConfigDecoder:
             else:
                 del o[k]
         return o
+
+
+if __name__ == '__main__':
+    # Usage: python config.py migrate conf/twitter.json [conf/twitter.db]
+    if len(sys.argv) not in (3, 4) or sys.argv[1] != 'migrate':
+        sys.exit(f'Usage: {sys.argv[0]} migrate <file.json> [<file.db>]')
+    print(f'Migrated {sys.argv[2]} to {migrate(*sys.argv[2:])}')
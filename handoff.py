@@ -0,0 +1,80 @@
+"""Hands the live state of cogs over to their next instance when their extension is reloaded.
+
+`Core.reload` opens a handoff for the extension before unloading it. Its cogs then offer their
+state from `cog_unload` instead of tearing it down, and their new instances claim it. A state
+that isn't claimed, whether its version doesn't match or the new instance failed to adopt it,
+is torn down and the new instance starts cold.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Handoff:
+    """The state a cog instance hands over, and how to tear it down if it isn't claimed."""
+
+    def __init__(self, version, state, teardown):
+        self.version = version
+        self.state = state
+        self.teardown = teardown
+
+
+def begin(bot, extension):
+    """Opens a handoff for the cogs of an extension about to be reloaded."""
+    bot.handoffs[extension] = {}
+
+
+def end(bot, extension):
+    """Closes the handoff of an extension, tearing down the states that weren't claimed."""
+    for name, handoff in getattr(bot, 'handoffs', {}).pop(extension, {}).items():
+        log.warning(f'State of {name} was not claimed, tearing it down')
+        handoff.teardown()
+
+
+def offer(bot, cog, version, state, teardown):
+    """Offers the state of a cog being unloaded to its next instance.
+
+    Returns False when its extension isn't being reloaded, the cog must then tear its state down itself.
+    """
+    handoffs = getattr(bot, 'handoffs', {}).get(type(cog).__module__)
+    if handoffs is None:
+        return False
+    handoffs[cog.qualified_name] = Handoff(version, state, teardown)
+    return True
+
+
+def claim(bot, cog, version, adopt):
+    """Passes the state offered by the previous instance of a cog to `adopt`.
+
+    Returns whether it was adopted. A state of another version, or that `adopt` fails on, is
+    torn down and the cog must start cold.
+    """
+    handoff = getattr(bot, 'handoffs', {}).get(type(cog).__module__, {}).pop(cog.qualified_name, None)
+    if handoff is None:
+        return False
+
+    if handoff.version != version:
+        log.info(f'State of {cog.qualified_name} is version {handoff.version}, expected {version}, starting cold')
+    else:
+        try:
+            adopt(handoff.state)
+        except Exception:
+            log.exception(f'Could not adopt the state of {cog.qualified_name}, starting cold')
+        else:
+            log.info(f'Adopted the state of {cog.qualified_name}')
+            return True
+
+    handoff.teardown()
+    return False
+
+
+def adopt(obj, cls):
+    """Makes an instance of the previous version of a class an instance of its reloaded version.
+
+    Raises TypeError if they aren't versions of the same class, or their layouts differ.
+    """
+    if type(obj) is not cls:
+        if type(obj).__qualname__ != cls.__qualname__:
+            raise TypeError(f'Cannot adopt a {type(obj).__qualname__} as a {cls.__qualname__}')
+        obj.__class__ = cls
+    return obj
@@ -0,0 +1,69 @@
+import bisect
+import collections
+import os
+
+# Default buckets, in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Histogram of observations.
+
+    Bucket counts are cumulative since creation, while percentiles are computed over a
+    rolling window of the latest observations.
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS, window=1000):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        """Records an observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, percent):
+        """Returns the given percentile of the recent observations, or None if there is none."""
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    def summary(self, scale=1, unit=''):
+        """Returns a short representation of the recent observations."""
+        if not self.recent:
+            return 'no data'
+        p50, p95, top = (self.percentile(p) * scale for p in (50, 95, 100))
+        return f'p50 {p50:.0f}{unit}, p95 {p95:.0f}{unit}, max {top:.0f}{unit} ({self.count} total)'
+
+    def prometheus(self, name, labels=None):
+        """Yields the lines of the histogram in the Prometheus text format."""
+        labels = dict(labels or {})
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{format_labels(labels)} {self.sum}'
+        yield f'{name}_count{format_labels(labels)} {self.count}'
+
+
+def format_labels(labels, **extra):
+    """Formats labels for the Prometheus text format."""
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    pairs = ','.join(f'{k}="{v}"' for k, v in labels.items())
+    return f'{{{pairs}}}'
+
+
+def write_atomically(file, content):
+    """Writes a text file without ever exposing it half written."""
+    tmp_file = file + '~'
+    with open(tmp_file, 'w', encoding='utf-8') as fp:
+        fp.write(content)
+    os.replace(tmp_file, file)
@@ -1,9 +1,15 @@
+import asyncio
 import json
 import logging
+import time
 
 import discord
 import discord.ext.commands as commands
 
+import config
+
+STARTED_AT = time.perf_counter()
+
 # Setup logging
 rlog = logging.getLogger()
 rlog.setLevel(logging.INFO)
@@ -12,23 +18,87 @@ handler.setFormatter(logging.Formatter('{asctime}:{levelname}:{name}:{message}',
 rlog.addHandler(handler)
 
 logging.getLogger('discord').setLevel(logging.WARNING)
+log = logging.getLogger(__name__)
 
 
 class Panda(commands.Bot):
     def __init__(self):
         # load the conf
         self.conf_file = 'conf/panda.json'
-        with open(self.conf_file) as fp:
-            self.conf = json.load(fp)
+        self.conf = config.Config(self.conf_file, schema=config.Schema())
 
         # Init the bot
         super().__init__(commands.when_mentioned_or(self.conf['prefix']), description='Never say no to Panda.')
 
-        # Load cogs
+        # Times in seconds since the start, and per extension import and setup times
+        self.startup_profile = {'connected': None, 'ready': None, 'extensions': {}}
+
+        # States handed over between the old and new cogs of the extensions being reloaded
+        self.handoffs = {}
+
+    async def on_ready(self):
+        """Loads the cogs once connected, so that their imports and setup don't delay it."""
+        if self.startup_profile['connected'] is not None:
+            return  # Reconnected
+        self.startup_profile['connected'] = time.perf_counter() - STARTED_AT
+        self.start_time = time.time()
+
         for cog_name in self.conf['extensions']:
-            self.load_extension(f'cogs.{cog_name}')
+            try:
+                self.load_extension(f'cogs.{cog_name}')
+            except commands.ExtensionError:
+                log.exception(f'Could not load extension {cog_name}')
+            await asyncio.sleep(0)  # Let the gateway's events through in between
+
+        self.startup_profile['ready'] = time.perf_counter() - STARTED_AT
+        log.info(f'Startup profile:\n{self.format_startup_profile()}')
+
+        # Keep a history of the startup profiles, to compare them across releases
+        if self.conf.get('startup_profile_file'):
+            with open(self.conf['startup_profile_file'], 'a', encoding='utf-8') as fp:
+                fp.write(json.dumps({'time': self.start_time, **self.startup_profile}) + '\n')
+
+    def load_extension(self, name):
+        """Loads an extension, recording its import and setup times."""
+        self._import_time = 0
+        start = time.perf_counter()
+        super().load_extension(name)
+        load_time = time.perf_counter() - start
+        self.startup_profile['extensions'][name] = {'import': self._import_time, 'setup': load_time - self._import_time}
+
+    def _load_from_module_spec(self, spec, key):
+        """Times the execution of the extension's module, apart from its setup."""
+        # Wrapping the loader leaves discord.py in charge of the import, and of turning its errors into ExtensionErrors
+        loader = spec.loader
+        exec_module = loader.exec_module
+
+        def timed_exec_module(module):
+            start = time.perf_counter()
+            try:
+                exec_module(module)
+            finally:
+                self._import_time = time.perf_counter() - start
+
+        loader.exec_module = timed_exec_module
+        try:
+            super()._load_from_module_spec(spec, key)
+        finally:
+            del loader.exec_module
+
+    def format_startup_profile(self):
+        """Returns a human readable startup profile."""
+        profile = self.startup_profile
+        if profile['ready'] is None:
+            return 'Still starting up'
+
+        lines = [f'Connected in {profile["connected"]:.2f} s, ready in {profile["ready"]:.2f} s']
+        for name, times in profile['extensions'].items():
+            lines.append(f'{name}: import {times["import"] * 1000:.0f} ms, setup {times["setup"] * 1000:.0f} ms')
+        return '\n'.join(lines)
 
 
 # Let's rock ! (and roll, because panda are round and fluffy)
-bot = Panda()
-bot.run(bot.conf['token'])
+# Guarded so that spawned worker processes don't start their own bot
+if __name__ == '__main__':
+    bot = Panda()
+    bot.run(bot.conf['token'])